@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Files per second of tree scan and hash commit.
+
+Hash commit saves precomputed hashes, measuring only the database writes,
+with a commit per file and with the default batch size.
+
+Usage: python benchmarks/database.py [--files N]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import deduplicated
+
+
+parser = argparse.ArgumentParser(description='Benchmark tree scan and hash commit')
+parser.add_argument('--files', type=int, default=10000,
+                    help='number of files')
+
+
+def create_tree(path, files):
+    for i in range(files):
+        dirname = os.path.join(path, 'dir%03d' % (i % 100))
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        with open(os.path.join(dirname, 'file%06d' % i), 'wb') as fp:
+            fp.write(b'x' * (i % 10))
+
+
+def run(path, commit_files):
+    cache_dir = tempfile.mkdtemp(prefix='deduplicated-cache-')
+    deduplicated.CACHE_DIR = cache_dir
+    deduplicated.COMMIT_FILES = commit_files
+    try:
+        directory = deduplicated.Directory(path)
+
+        start = time.time()
+        directory.update_tree()
+        tree_time = time.time() - start
+
+        filenames = list(directory.files_for_update())
+        start = time.time()
+        for filename in filenames:
+            directory.update_hash(filename, (0, 0, '0' * 40))
+        directory.save_database()
+        hash_time = time.time() - start
+    finally:
+        shutil.rmtree(cache_dir)
+    return tree_time, hash_time, len(filenames)
+
+
+def main():
+    files = parser.parse_args().files
+    batch = deduplicated.COMMIT_FILES
+
+    path = tempfile.mkdtemp(prefix='deduplicated-bench-')
+    try:
+        create_tree(path, files)
+        print('%d files' % files)
+        for name, commit_files in (('commit per file', 1), ('commit per %d files' % batch, batch)):
+            tree_time, hash_time, hashed = run(path, commit_files)
+            print('%-22s tree scan: %10.0f files/s  hash commit: %10.0f files/s' % (
+                name,
+                files / tree_time,
+                hashed / hash_time,
+            ))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Throughput of available hash algorithms hashing data in memory.
+
+Usage: python benchmarks/hash_algorithms.py [--size MB] [--block KB]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import time
+
+import deduplicated
+
+
+parser = argparse.ArgumentParser(description='Benchmark hash algorithms')
+parser.add_argument('--size', type=float, default=512,
+                    help='data hashed by each algorithm in MB')
+parser.add_argument('--block', type=float, default=1024,
+                    help='size of each update in KB')
+
+
+def run(algorithm, data, total):
+    s = deduplicated.new_hash(algorithm)
+    start = time.time()
+    for _ in range(total // len(data)):
+        s.update(data)
+    s.hexdigest()
+    return time.time() - start
+
+
+def main():
+    args = parser.parse_args()
+    total = int(args.size * 2 ** 20)
+    data = os.urandom(int(args.block * 2 ** 10))
+
+    print('%s in blocks of %s' % (deduplicated.str_size(total), deduplicated.str_size(len(data))))
+    for algorithm in sorted(deduplicated.HASH_ALGORITHMS):
+        seconds = min(run(algorithm, data, total) for _ in range(3))
+        print('%-8s %6.2f GB/s' % (algorithm, total / seconds / 2 ** 30))
+
+
+if __name__ == '__main__':
+    main()
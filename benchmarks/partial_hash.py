@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Bytes read by hashing with and without the partial hash stage.
+
+Usage: python benchmarks/partial_hash.py [--files N] [--size MB]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import tempfile
+
+import deduplicated
+
+
+parser = argparse.ArgumentParser(description='Benchmark bytes read with and without partial hash')
+parser.add_argument('--files', type=int, default=20,
+                    help='number of files, all with same size')
+parser.add_argument('--size', type=float, default=4,
+                    help='size of each file in MB')
+
+
+def create_tree(path, files, size):
+    # All files with same size, only first pair is duplicated
+    for i in range(files):
+        filename = os.path.join(path, 'file%04d' % i)
+        if i == 1:
+            shutil.copyfile(os.path.join(path, 'file0000'), filename)
+            continue
+        with open(filename, 'wb') as fp:
+            fp.write(os.urandom(size))
+
+
+def run(path, partial_block):
+    counter = {'partial': 0, 'full': 0}
+    digest_file = deduplicated.digest_file
+    digest_partial = deduplicated.digest_partial
+
+    def count_digest_file(filename, *args):
+        counter['full'] += os.path.getsize(filename)
+        return digest_file(filename, *args)
+
+    def count_digest_partial(filename, *args):
+        counter['partial'] += min(os.path.getsize(filename), 2 * deduplicated.PARTIAL_HASH_BLOCK)
+        return digest_partial(filename, *args)
+
+    cache_dir = tempfile.mkdtemp(prefix='deduplicated-cache-')
+    deduplicated.CACHE_DIR = cache_dir
+    deduplicated.PARTIAL_HASH_BLOCK = partial_block
+    deduplicated.digest_file = count_digest_file
+    deduplicated.digest_partial = count_digest_partial
+    try:
+        directory = deduplicated.Directory(path)
+        directory.update_tree()
+        for filename in directory.hash_for_update():
+            directory.update_hash(filename)
+        duplicated = directory.get_duplicated_hash()
+    finally:
+        deduplicated.digest_file = digest_file
+        deduplicated.digest_partial = digest_partial
+        shutil.rmtree(cache_dir)
+    return counter['partial'], counter['full'], duplicated
+
+
+def main():
+    args = parser.parse_args()
+    files = args.files
+    size = int(args.size * 2 ** 20)
+    block = deduplicated.PARTIAL_HASH_BLOCK
+
+    path = tempfile.mkdtemp(prefix='deduplicated-bench-')
+    try:
+        create_tree(path, files, size)
+        print('%d files of %s' % (files, deduplicated.str_size(size)))
+        for name, partial_block in (('without partial hash', 0), ('with partial hash', block)):
+            partial, full, duplicated = run(path, partial_block)
+            print('%-21s partial: %10s  full: %10s  total: %10s  (%d duplicated)' % (
+                name,
+                deduplicated.str_size(partial),
+                deduplicated.str_size(full),
+                deduplicated.str_size(partial + full),
+                duplicated,
+            ))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Throughput and peak memory of the ways of reading files for hash.
+
+Each method runs in its own process to measure its peak RSS. Files are
+read from page cache after the first run, to measure cold reads drop the
+cache (as root: echo 3 > /proc/sys/vm/drop_caches) and use --repeat 1.
+
+Usage: python benchmarks/read_path.py [--sizes MB,...] [--repeat N]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import deduplicated
+
+
+METHODS = ('1k-read', 'readinto', 'mmap')
+
+parser = argparse.ArgumentParser(description='Benchmark read of files for hash')
+parser.add_argument('--sizes', default='0.004,1,64,512',
+                    help='file sizes in MB separated by comma')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='reads of each file, the fastest is reported')
+parser.add_argument('--child', nargs=3, metavar=('METHOD', 'FILE', 'REPEAT'),
+                    help=argparse.SUPPRESS)
+
+
+def digest_1k_read(filename):
+    # Read path before readinto, a new bytes object for each KB
+    with open(filename, 'rb') as fp:
+        s = deduplicated.new_hash('sha1')
+        block = True
+        while block:
+            block = fp.read(2 ** 10)
+            s.update(block)
+        return s.hexdigest()
+
+
+def digest_sha1(filename):
+    return deduplicated.digest_file(filename, 'sha1')
+
+
+def child(method, filename, repeat):
+    deduplicated.DROP_PAGE_CACHE = False
+    if method == '1k-read':
+        digest = digest_1k_read
+    else:
+        deduplicated.MMAP_MIN_SIZE = 1 if method == 'mmap' else 0
+        digest = digest_sha1
+    seconds = None
+    for _ in range(repeat):
+        start = time.time()
+        digest(filename)
+        elapsed = time.time() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': seconds, 'maxrss': maxrss * (1 if sys.platform == 'darwin' else 1024)}))
+
+
+def main():
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], int(args.child[2]))
+        return
+
+    path = tempfile.mkdtemp(prefix='deduplicated-bench-')
+    try:
+        print('%-10s  %-8s  %10s  %10s' % ('Size', 'Method', 'MB/s', 'Peak RSS'))
+        for size in [int(float(size) * 2 ** 20) for size in args.sizes.split(',')]:
+            filename = os.path.join(path, 'file')
+            with open(filename, 'wb') as fp:
+                for _ in range(size // 2 ** 20):
+                    fp.write(os.urandom(2 ** 20))
+                fp.write(os.urandom(size % 2 ** 20))
+            for method in METHODS:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                                  '--child', method, filename, str(args.repeat)])
+                result = json.loads(output.decode('utf-8'))
+                print('%-10s  %-8s  %10.1f  %10s' % (
+                    deduplicated.str_size(size),
+                    method,
+                    size / (result['seconds'] or float('nan')) / 2 ** 20,
+                    deduplicated.str_size(result['maxrss']),
+                ))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Size of cache database and time of tree update and duplicated report.
+
+Tree has many small files in long paths, as a source tree or a mail
+directory, where the cache is mostly paths and hashs. Results are written
+as JSON, to compare between commits run with same arguments.
+
+Usage: python benchmarks/storage.py [options]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import deduplicated
+from suite import git_commit
+
+
+parser = argparse.ArgumentParser(description='Benchmark cache database size and queries')
+parser.add_argument('--files', type=int, default=50000,
+                    help='number of files')
+parser.add_argument('--per-directory', type=int, default=50,
+                    help='files in each directory')
+parser.add_argument('--duplicates', type=float, default=0.2,
+                    help='fraction of files with content of other file')
+parser.add_argument('-o', '--output',
+                    help='write results to file instead of stdout')
+
+
+def create_tree(path, files, per_directory, duplicates):
+    # Files in project/module_NNN/src/package_name/subpackage_NN, sizes repeat so most files are hashed
+    unique = max(1, int(files * (1 - duplicates)))
+    for i in range(files):
+        dirname = os.path.join(path, 'project', 'module_%03d' % (i // per_directory // 20), 'src',
+                               'package_name', 'subpackage_%02d' % (i // per_directory % 20))
+        if i % per_directory == 0:
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'source_file_%06d.txt' % i), 'wb') as fp:
+            fp.write(('content %d\n' % (i % unique)).encode('ascii') * (1 + i % unique % 7))
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def count_duplicated(duplicated):
+    return sum(len(files) for _, _, files in duplicated)
+
+
+def run(path):
+    cache_dir = tempfile.mkdtemp(prefix='deduplicated-cache-')
+    deduplicated.CACHE_DIR = cache_dir
+    try:
+        directory = deduplicated.Directory(path)
+        results = {}
+        results['tree_seconds'], _ = timed(directory.update_tree)
+        results['hash_seconds'], hashed = timed(lambda: len(list(directory.update_hash_parallel())))
+        results['hashed_files'] = hashed
+        results['retree_seconds'], _ = timed(directory.update_tree)
+        results['duplicated_seconds'], results['duplicated_files'] = timed(
+            lambda: count_duplicated(directory.get_duplicated()))
+        results['duplicated_page_seconds'], _ = timed(
+            lambda: count_duplicated(directory.get_duplicated('wasted', True, 100)))
+        results['optimize_seconds'], sizes = timed(directory.optimize_database)
+        results['database_bytes'] = sizes[0]
+        results['database_optimized_bytes'] = sizes[1]
+    finally:
+        shutil.rmtree(cache_dir)
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    params = dict(vars(args))
+    del params['output']
+
+    path = tempfile.mkdtemp(prefix='deduplicated-bench-')
+    try:
+        create_tree(path, args.files, args.per_directory, args.duplicates)
+        results = run(path)
+    finally:
+        shutil.rmtree(path)
+
+    result = {
+        'version': deduplicated.__version__,
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'params': params,
+        'results': results,
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
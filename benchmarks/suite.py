@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Time tree walk, hashing and duplicated report of a synthetic tree.
+
+Results are written as JSON, to compare between commits run with same
+arguments.
+
+Usage: python benchmarks/suite.py [options]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import deduplicated
+from synthetic import DISTRIBUTIONS, create_tree
+
+
+parser = argparse.ArgumentParser(description='Benchmark phases of directory update')
+parser.add_argument('--files', type=int, default=2000,
+                    help='number of files')
+parser.add_argument('--size-min', type=int, default=2 ** 10,
+                    help='minimum file size in bytes')
+parser.add_argument('--size-max', type=int, default=2 ** 20,
+                    help='maximum file size in bytes')
+parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='lognormal',
+                    help='distribution of file sizes')
+parser.add_argument('--duplicates', type=float, default=0.1,
+                    help='fraction of files copied from other file')
+parser.add_argument('--hardlinks', type=float, default=0.0,
+                    help='fraction of files hardlinked to other file')
+parser.add_argument('--depth', type=int, default=3,
+                    help='depth of directories')
+parser.add_argument('--width', type=int, default=4,
+                    help='subdirectories in each directory')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of random generator')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of directories listed and files hashed in parallel')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='runs of each phase, the fastest is reported')
+parser.add_argument('-o', '--output',
+                    help='write results to file instead of stdout')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(path, jobs):
+    cache_dir = tempfile.mkdtemp(prefix='deduplicated-cache-')
+    deduplicated.CACHE_DIR = cache_dir
+    try:
+        directory = deduplicated.Directory(path)
+
+        start = time.time()
+        insert, _, _ = directory.update_tree(jobs)
+        tree = {'seconds': time.time() - start, 'files': insert}
+
+        start = time.time()
+        hashed = list(directory.update_hash_parallel(jobs))
+        hashing = {'seconds': time.time() - start, 'files': len(hashed)}
+        hashing['bytes'] = sum(os.path.getsize(os.path.join(path, filename)) for filename in hashed)
+
+        start = time.time()
+        groups = 0
+        files_count = 0
+        for _, _, files in directory.get_duplicated():
+            groups += 1
+            files_count += sum(len(links) for links in files)
+        report = {'seconds': time.time() - start, 'hashs': groups, 'files': files_count}
+    finally:
+        shutil.rmtree(cache_dir)
+    return {'tree': tree, 'hash': hashing, 'report': report}
+
+
+def main():
+    args = parser.parse_args()
+    params = dict(vars(args))
+    del params['output']
+
+    path = tempfile.mkdtemp(prefix='deduplicated-bench-')
+    try:
+        tree = create_tree(path, args.files, args.size_min, args.size_max, args.distribution,
+                           args.duplicates, args.hardlinks, args.depth, args.width, args.seed)
+        runs = [run(path, args.jobs) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(path)
+
+    phases = {}
+    for phase in ('tree', 'hash', 'report'):
+        phases[phase] = min((r[phase] for r in runs), key=lambda result: result['seconds'])
+        seconds = phases[phase]['seconds'] or float('nan')
+        phases[phase]['files_per_second'] = phases[phase]['files'] / seconds
+        if 'bytes' in phases[phase]:
+            phases[phase]['bytes_per_second'] = phases[phase]['bytes'] / seconds
+
+    result = {
+        'version': deduplicated.__version__,
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'params': params,
+        'tree': tree,
+        'phases': phases,
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
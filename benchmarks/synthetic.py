@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+"""Reproducible synthetic directory trees for benchmarks."""
+
+from __future__ import unicode_literals
+
+from hashlib import sha512
+import os
+import random
+
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def file_size(rng, distribution, size_min, size_max):
+    if distribution == 'fixed':
+        return size_max
+    if distribution == 'uniform':
+        return rng.randint(size_min, size_max)
+    if distribution == 'lognormal':
+        # Many small files and few big ones, median at size_min * 4
+        size = int(rng.lognormvariate(0, 1.5) * size_min * 4)
+        return max(size_min, min(size_max, size))
+    raise ValueError('invalid distribution %s' % distribution)
+
+
+def write_file(filename, seed, size):
+    # Different seeds give different first and last blocks
+    block = sha512(('%s' % seed).encode('ascii')).digest() * 64
+    with open(filename, 'wb') as fp:
+        for _ in range(size // len(block)):
+            fp.write(block)
+        fp.write(block[:size % len(block)])
+
+
+def create_tree(path, files=1000, size_min=2 ** 10, size_max=2 ** 20, distribution='lognormal',
+                duplicates=0.1, hardlinks=0.0, depth=3, width=4, seed=0):
+    """Create files in path and return a dict with what was created.
+
+    duplicates and hardlinks are the fraction of files that are copies and
+    hardlinks of a previous file, the other files have unique content.
+    """
+    rng = random.Random(seed)
+    dirnames = ['']
+    level_dirnames = ['']
+    for _ in range(depth):
+        level_dirnames = [os.path.join(dirname, 'dir%d' % i) for dirname in level_dirnames for i in range(width)]
+        dirnames += level_dirnames
+    for dirname in dirnames:
+        if dirname:
+            os.makedirs(os.path.join(path, dirname))
+
+    created = []
+    stats = {'files': 0, 'bytes': 0, 'unique': 0, 'duplicates': 0, 'hardlinks': 0}
+    for i in range(files):
+        filename = os.path.join(path, rng.choice(dirnames), 'file%06d' % i)
+        kind = rng.random()
+        if created and kind < hardlinks:
+            os.link(rng.choice(created)[0], filename)
+            stats['hardlinks'] += 1
+            stats['files'] += 1
+            continue
+        if created and kind < hardlinks + duplicates:
+            _, source_seed, size = rng.choice(created)
+            write_file(filename, source_seed, size)
+            stats['duplicates'] += 1
+        else:
+            source_seed = '%s:%d' % (seed, i)
+            size = file_size(rng, distribution, size_min, size_max)
+            write_file(filename, source_seed, size)
+            stats['unique'] += 1
+        created.append((filename, source_seed, size))
+        stats['files'] += 1
+        stats['bytes'] += size
+    stats['directories'] = len(dirnames)
+    return stats
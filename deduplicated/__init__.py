@@ -6,17 +6,50 @@
 
 from __future__ import unicode_literals
 
+import binascii
+from contextlib import closing, contextmanager
 from datetime import datetime
+from fnmatch import translate
+from functools import partial
+import hashlib
 from hashlib import sha1
+import mmap
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import sqlite3
+import stat as stat_mode
+import struct
 import sys
+import time
+import zlib
+
+from .metrics import connect
 
 # workaround for Python 2
 try:
     from configparser import ConfigParser
 except ImportError:
     from ConfigParser import ConfigParser
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# optional hash algorithms
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 if sys.version_info[0] == 2:
     reload(sys)  # NOQA
@@ -27,20 +60,422 @@ if sys.version_info[0] == 2:
 
 __version__ = '1.0.dev0'
 CACHE_DIR = os.path.join(os.path.expanduser('~'), '.deduplicated')
+PARTIAL_HASH_BLOCK = 2 ** 16
+COMMIT_FILES = 1000
+COMMIT_SECONDS = 30
+# Pending files read from database at once by updates
+PENDING_FILES = 1000
+
+# Read of files for hash, block grows with file size up to READ_BLOCK_MAX
+READ_BLOCK_MIN = 2 ** 16
+READ_BLOCK_MAX = 2 ** 20
+# Files from this size are mapped in memory, 0 disable (mapped files truncated while read kill the process)
+MMAP_MIN_SIZE = 0
+# Remove read files from page cache after hash, also pages cached before by programs using the file, so
+# only for hosts without other workload (SEQUENTIAL and NOREUSE advices are always given)
+DROP_PAGE_CACHE = False
+# Verify of duplicated files read this block of each file at once, from up to VERIFY_OPEN_FILES files
+VERIFY_BLOCK = 2 ** 16
+VERIFY_OPEN_FILES = 256
+
+# Similar files, content is split in chunks ending in a newline or zero byte (up to CHUNK_MAX bytes),
+# fingerprints are MinHash of chunks in SIMILAR_BINS bins, files smaller than SIMILAR_MIN_SIZE are ignored
+CHUNK_END = re.compile(b'[\n\x00]')
+CHUNK_MAX = 2 ** 12
+SIMILAR_BINS = 64
+SIMILAR_MIN_SIZE = 2 ** 12
+SIMILAR_THRESHOLD = 0.8
+
+# Blocks, content defined chunks from BLOCK_MIN to BLOCK_MAX bytes, cut after a newline byte when CRC-32 of the
+# BLOCK_WINDOW bytes before the cut has the BLOCK_MASK bits zero, so re and zlib find cuts at C speed, stored as
+# BLOCK_DIGEST_SIZE bytes of its SHA-1 and its size
+BLOCK_MIN = 2 ** 12
+BLOCK_MAX = 2 ** 16
+BLOCK_ANCHOR = re.compile(b'\n')
+BLOCK_WINDOW = 16
+# One newline of 64 cuts, chunks of about 20 KB in binary files (a newline by 256 bytes), smaller in text files
+BLOCK_MASK = 0x3f
+BLOCK_DIGEST_SIZE = 8
+BLOCK_ENTRY = struct.Struct(str('<%dsI' % BLOCK_DIGEST_SIZE))
+# Files chunked from this size, small files (most of the files, few of the bytes) are left to the whole file hash
+BLOCK_FILE_MIN = 2 ** 20
+
+# Files are stored by directory, interned in dirs table, and name
+SQL_FILES = 'files JOIN dirs ON dirs.id = files.dir'
+SQL_FILENAME = "CASE dirs.path WHEN '' THEN files.name ELSE dirs.path || '/' || files.name END"
+# Hardlinks are the same file, count and hash them once
+SQL_INODE = "IFNULL(files.dev || ':' || files.inode, files.id)"
+# Sizes of files changed by an update of some paths (see update_tree), the hash run after it looks only at them
+SQL_TOUCHED = 'files.size IN (SELECT size FROM touched)'
+# Ids of directories kept in memory by path
+DIRS_CACHE = 2 ** 16
+# Nanoseconds, mtimes of caches from float seconds are converted with an error under 1 µs
+MTIME_TOLERANCE = 1000
+
+# Algorithms for content hash, each cache records the one used by its files
+HASH_ALGORITHM = 'sha1'
+HASH_ALGORITHMS = {'sha1': sha1}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = partial(hashlib.blake2b, digest_size=20)
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
 
 
 # Utils
 
-def sha1_file(filename):
+def new_hash(algorithm):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('hash algorithm %s is not available' % algorithm)
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def fadvise(fd, advice):
+    if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def read_into_hash(s, fp, size):
+    # Reuse the same buffer for all blocks
+    buf = bytearray(min(READ_BLOCK_MAX, max(READ_BLOCK_MIN, size + 1)))
+    view = memoryview(buf)
+    read = fp.readinto(buf)
+    while read:
+        s.update(view[:read])
+        read = fp.readinto(buf)
+
+
+def mmap_into_hash(s, fp, size):
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        for offset in range(0, len(mapped), READ_BLOCK_MAX):
+            s.update(view[offset:offset + READ_BLOCK_MAX])
+        del view
+    finally:
+        mapped.close()
+
+
+def digest_file(filename, algorithm=HASH_ALGORITHM):
+    s = new_hash(algorithm)
+    with open(filename, 'rb') as fp:
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        fadvise(fd, 'POSIX_FADV_NOREUSE')
+        try:
+            if MMAP_MIN_SIZE and size >= MMAP_MIN_SIZE:
+                mmap_into_hash(s, fp, size)
+            else:
+                read_into_hash(s, fp, size)
+        finally:
+            if DROP_PAGE_CACHE:
+                fadvise(fd, 'POSIX_FADV_DONTNEED')
+    return s.hexdigest()
+
+
+def digest_partial(filename, algorithm=HASH_ALGORITHM, block=None):
+    if block is None:
+        block = PARTIAL_HASH_BLOCK
     with open(filename, 'rb') as fp:
-        s = sha1()
-        block = True
-        while block:
-            block = fp.read(2 ** 10)
-            s.update(block)
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(0)
+        s = new_hash(algorithm)
+        s.update(str(size).encode('ascii'))
+        s.update(fp.read(block))
+        if size > block:
+            fp.seek(max(block, size - block))
+            s.update(fp.read(block))
         return s.hexdigest()
 
 
+def partial_hash_min_size():
+    # Small files are read whole by digest_partial, files up to this size use full hash only, None if disabled
+    return 2 * PARTIAL_HASH_BLOCK if PARTIAL_HASH_BLOCK else None
+
+
+def sha1_file(filename):
+    return digest_file(filename, 'sha1')
+
+
+def mtime_ns(stat):
+    # Python 2 has only float seconds
+    if hasattr(stat, 'st_mtime_ns'):
+        return stat.st_mtime_ns
+    return int(stat.st_mtime * 10 ** 9)
+
+
+def hash_file(filename, algorithm=HASH_ALGORITHM):
+    stat = os.stat(filename)
+    return mtime_ns(stat), stat.st_size, digest_file(filename, algorithm)
+
+
+def hash_to_blob(hexdigest):
+    if hexdigest is None:
+        return None
+    return sqlite3.Binary(binascii.unhexlify(hexdigest))
+
+
+def hash_from_blob(blob):
+    if blob is None:
+        return None
+    return binascii.hexlify(bytes(blob)).decode('ascii')
+
+
+def compare_files(filenames, block=None):
+    # Files are read together block by block, a file leaves the comparison in its first block different of others,
+    # returns groups of files with same content, files not read are alone
+    if block is None:
+        block = VERIFY_BLOCK
+    if len(filenames) > VERIFY_OPEN_FILES:
+        # Compare batches of files with the first, files different of it are compared only inside its batch
+        reference, same, groups = filenames[0], [], []
+        step = VERIFY_OPEN_FILES - 1
+        for i in range(1, len(filenames), step):
+            for group in compare_files([reference] + filenames[i:i + step], block):
+                if group[0] == reference:
+                    same += group[1:]
+                else:
+                    groups.append(group)
+        return [[reference] + same] + groups
+
+    order = dict((filename, i) for i, filename in enumerate(filenames))
+    groups = []
+    files = {}
+    try:
+        for filename in filenames:
+            try:
+                files[filename] = open(filename, 'rb')
+            except (IOError, OSError):
+                groups.append([filename])
+                continue
+            fadvise(files[filename].fileno(), 'POSIX_FADV_SEQUENTIAL')
+        pending = [[filename for filename in filenames if filename in files]]
+        while pending:
+            blocks = {}
+            for filename in pending.pop():
+                try:
+                    data = files[filename].read(block)
+                except (IOError, OSError):
+                    groups.append([filename])
+                    continue
+                blocks.setdefault(data, []).append(filename)
+            for data, members in blocks.items():
+                if len(members) > 1 and data:
+                    pending.append(members)
+                else:
+                    groups.append(members)
+    finally:
+        for fp in files.values():
+            if DROP_PAGE_CACHE:
+                fadvise(fp.fileno(), 'POSIX_FADV_DONTNEED')
+            fp.close()
+    return sorted((group for group in groups if group), key=lambda group: order[group[0]])
+
+
+def content_chunks(fp):
+    # Chunks end in content, an insert change only chunks near it
+    rest = b''
+    block = fp.read(READ_BLOCK_MAX)
+    while block:
+        chunks = CHUNK_END.split(rest + block)
+        rest = chunks.pop()
+        for chunk in chunks:
+            for offset in range(0, len(chunk), CHUNK_MAX):
+                yield chunk[offset:offset + CHUNK_MAX]
+        while len(rest) > CHUNK_MAX:
+            yield rest[:CHUNK_MAX]
+            rest = rest[CHUNK_MAX:]
+        block = fp.read(READ_BLOCK_MAX)
+    if rest:
+        yield rest
+
+
+def fingerprint_file(filename, bins=None):
+    # One permutation MinHash: chunk hash select a bin and the minimum of each bin is kept, empty bins are 2 ** 32 - 1
+    if bins is None:
+        bins = SIMILAR_BINS
+    mins = [2 ** 32 - 1] * bins
+    with open(filename, 'rb') as fp:
+        fadvise(fp.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        for chunk in content_chunks(fp):
+            value = (zlib.crc32(chunk) & 0xffffffff) * 0x9e3779b1 & 0xffffffff
+            if value // bins < mins[value % bins]:
+                mins[value % bins] = value // bins
+        if DROP_PAGE_CACHE:
+            fadvise(fp.fileno(), 'POSIX_FADV_DONTNEED')
+    return struct.pack(str('<%dI' % bins), *mins)
+
+
+def similarity(fingerprint1, fingerprint2):
+    # Estimated Jaccard similarity of chunks, from bins not empty in both
+    empty = 2 ** 32 - 1
+    values1 = struct.unpack(str('<%dI' % (len(fingerprint1) // 4)), fingerprint1)
+    values2 = struct.unpack(str('<%dI' % (len(fingerprint2) // 4)), fingerprint2)
+    bins = [(value1, value2) for value1, value2 in zip(values1, values2) if value1 != empty or value2 != empty]
+    if not bins:
+        return 0.0
+    return sum(1 for value1, value2 in bins if value1 == value2) / float(len(bins))
+
+
+def lsh_rows(threshold, bins):
+    # Rows by LSH band, probability of candidate is 50% near (1 / bands) ** (1 / rows), choose it below threshold
+    rows = 1
+    for candidate in range(1, bins + 1):
+        if bins % candidate == 0 and (float(candidate) / bins) ** (1.0 / candidate) <= threshold:
+            rows = candidate
+    return rows
+
+
+def lsh_keys(fingerprint, rows):
+    # Bands of fingerprint, bands of only empty bins are skipped
+    empty = struct.pack(str('<%dI' % rows), *([2 ** 32 - 1] * rows))
+    fingerprint = bytes(fingerprint)
+    for band in range(len(fingerprint) // 4 // rows):
+        key = fingerprint[band * rows * 4:(band + 1) * rows * 4]
+        if key != empty:
+            yield band, key
+
+
+def block_cut(data, start, end):
+    # End of chunk starting at start, data is a bytearray
+    if end - start <= BLOCK_MIN:
+        return end
+    limit = min(start + BLOCK_MAX, end)
+    for match in BLOCK_ANCHOR.finditer(data, start + BLOCK_MIN - 1, limit):
+        cut = match.end()
+        if not zlib.crc32(data[cut - BLOCK_WINDOW:cut]) & BLOCK_MASK:
+            return cut
+    return limit
+
+
+def block_chunks(fp):
+    data = bytearray()
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(data) - start < BLOCK_MAX:
+            block = fp.read(READ_BLOCK_MAX)
+            if block:
+                del data[:start]
+                start = 0
+                data += block
+                continue
+            eof = True
+        if start >= len(data):
+            return
+        end = block_cut(data, start, len(data))
+        yield bytes(data[start:end])
+        start = end
+
+
+def block_file(filename):
+    # Packed (digest, size) of chunks
+    entries = []
+    with open(filename, 'rb') as fp:
+        fadvise(fp.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        for chunk in block_chunks(fp):
+            entries.append(BLOCK_ENTRY.pack(sha1(chunk).digest()[:BLOCK_DIGEST_SIZE], len(chunk)))
+        if DROP_PAGE_CACHE:
+            fadvise(fp.fileno(), 'POSIX_FADV_DONTNEED')
+    return b''.join(entries)
+
+
+def block_entries(blocks):
+    blocks = bytes(blocks)
+    for offset in range(0, len(blocks), BLOCK_ENTRY.size):
+        yield BLOCK_ENTRY.unpack_from(blocks, offset)
+
+
+def group_duplicated(rows):
+    # rows of (hash, size, filename, dev, inode) sorted by hash
+    hashfile, size, links = None, None, {}
+    for row in rows:
+        if row[0] != hashfile:
+            if hashfile is not None:
+                yield hashfile, size, sorted(links.values())
+            hashfile, size, links = row[0], row[1], {}
+        # Group hardlinks, only one of them use space
+        key = (row[3], row[4]) if row[4] is not None else row[2]
+        links.setdefault(key, []).append(row[2])
+    if hashfile is not None:
+        yield hashfile, size, sorted(links.values())
+
+
+def compile_exclude(patterns):
+    # Lines are exact paths, globs (matching only the name if without /) or regex prefixed by re:
+    exact = set()
+    regexes = []
+    path_patterns = []
+    name_patterns = []
+    for pattern in patterns:
+        if not pattern:
+            continue
+        if pattern.startswith('re:'):
+            # Compiled alone, flags as (?i) apply only to its line
+            try:
+                regexes.append(re.compile(pattern[3:]))
+            except re.error as e:
+                raise ValueError('invalid exclude %s: %s' % (pattern, e))
+        elif any(c in pattern for c in '*?['):
+            pattern = pattern.rstrip('/')
+            (path_patterns if '/' in pattern else name_patterns).append(translate(pattern))
+        else:
+            exact.add(pattern.rstrip('/'))
+    path_re = re.compile('|'.join(path_patterns)) if path_patterns else None
+    name_re = re.compile('|'.join(name_patterns)) if name_patterns else None
+
+    def is_excluded(partial_filename, filename):
+        return (partial_filename in exact or
+                any(regex.match(partial_filename) for regex in regexes) or
+                bool(path_re and path_re.match(partial_filename)) or
+                bool(name_re and name_re.match(filename)))
+    return is_excluded
+
+
+def scan_directory(path, follow_link=False):
+    # Stat of directories is only used to detect loops when following links
+    entries = []
+    try:
+        iterator = scandir(path)
+    except OSError:
+        return entries
+    for entry in iterator:
+        try:
+            if not follow_link and entry.is_symlink():
+                continue
+            is_dir = entry.is_dir()
+            stat = entry.stat() if not is_dir or follow_link else None
+        except OSError:
+            continue
+        entries.append((entry.name, is_dir, stat))
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+@contextmanager
+def files_pool(jobs=1, processes=False):
+    # Workers of Directory.map_files, None (files read in this thread) for one job
+    pool = (Pool if processes else ThreadPool)(jobs) if jobs > 1 else None
+    try:
+        yield pool
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def str_time(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
 def str_size(size):
     size = float(size)
     if size < 2 ** 10:
@@ -54,9 +489,190 @@ def str_size(size):
     return '%.2f TB' % (size / (2 ** 40))
 
 
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+# Database migrations, must be safe to run again if interrupted
+
+def add_column(db, table, column, column_type):
+    db.execute('PRAGMA table_info(%s)' % table)
+    if column not in [row[1] for row in db.fetchall()]:
+        db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+
+
+def migration_files(db):
+    # exist: 1 waiting hash, 2 hashed, 3 unique size or partial hash (hash not needed)
+    db.execute('CREATE TABLE IF NOT EXISTS files '
+               '(filename TEXT PRIMARY KEY, mtime FLOAT, size INT, hash TEXT, exist INT)')
+
+
+def migration_partialhash(db):
+    add_column(db, 'files', 'partialhash', 'TEXT')
+
+
+def migration_inode(db):
+    add_column(db, 'files', 'dev', 'INT')
+    add_column(db, 'files', 'inode', 'INT')
+    db.execute('CREATE INDEX IF NOT EXISTS files_inode ON files (dev, inode)')
+    db.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+
+
+def migration_indexes(db):
+    db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+    db.execute('CREATE INDEX IF NOT EXISTS files_exist ON files (exist)')
+
+
+def migration_runs(db):
+    # Journal of hash runs, an unfinished run is resumed by next update
+    db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, finished TEXT, '
+               'files_total INT, bytes_total INT, files_done INT, bytes_done INT, seconds FLOAT)')
+
+
+def migration_fingerprint(db):
+    add_column(db, 'files', 'fingerprint', 'BLOB')
+
+
+def migration_blocks(db):
+    add_column(db, 'files', 'blocks', 'BLOB')
+
+
+def migration_blocks_anchor(db):
+    # Blocks of gear hash chunking do not match blocks cut after newlines, files are chunked again
+    db.execute('UPDATE files SET blocks = NULL')
+
+
+def migration_compact(db):
+    # Path of directories once in dirs, files by directory and name, hashs as bytes and mtime in nanoseconds
+    db.execute('CREATE TABLE IF NOT EXISTS dirs (id INTEGER PRIMARY KEY, parent INT, path TEXT)')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS dirs_path ON dirs (path)')
+    db.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+    db.execute('PRAGMA table_info(files)')
+    if 'filename' not in [row[1] for row in db.fetchall()]:
+        return
+    db.execute('DROP TABLE IF EXISTS files_compact')
+    db.execute('CREATE TABLE files_compact (id INTEGER PRIMARY KEY, dir INT, name TEXT, mtime INT, size INT, '
+               'hash BLOB, exist INT, partialhash BLOB, dev INT, inode INT, fingerprint BLOB, blocks BLOB)')
+    dirs = {}
+    cursor = db.connection.cursor()
+
+    def get_dir(path):
+        if path not in dirs:
+            parent = get_dir(path.rpartition('/')[0]) if path else None
+            cursor.execute('INSERT INTO dirs (parent, path) VALUES (?, ?)', (parent, path))
+            dirs[path] = cursor.lastrowid
+        return dirs[path]
+
+    def compact_rows(rows):
+        for row in rows:
+            dirname, _, name = row[0].rpartition('/')
+            mtime = int(round(row[1] * 10 ** 9)) if row[1] is not None else None
+            yield (get_dir(dirname), name, mtime, row[2], hash_to_blob(row[3]), row[4],
+                   hash_to_blob(row[5])) + tuple(row[6:])
+
+    rows = db.connection.cursor()
+    rows.execute('SELECT filename, mtime, size, hash, exist, partialhash, dev, inode, fingerprint, blocks FROM files '
+                 'ORDER BY filename')
+    db.executemany('INSERT INTO files_compact (dir, name, mtime, size, hash, exist, partialhash, dev, inode, '
+                   'fingerprint, blocks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', compact_rows(rows))
+    db.execute('DROP TABLE files')
+    db.execute('ALTER TABLE files_compact RENAME TO files')
+    db.execute('CREATE UNIQUE INDEX files_name ON files (dir, name)')
+    db.execute('CREATE INDEX files_inode ON files (dev, inode)')
+    db.execute('CREATE INDEX files_hash ON files (hash)')
+    db.execute('CREATE INDEX files_size ON files (size)')
+    db.execute('CREATE INDEX files_exist ON files (exist)')
+
+
+# Schema version is the number of migrations applied
+MIGRATIONS = [
+    migration_files,
+    migration_partialhash,
+    migration_inode,
+    migration_indexes,
+    migration_runs,
+    migration_fingerprint,
+    migration_blocks,
+    migration_compact,
+    migration_blocks_anchor,
+]
+
+
+# Catalog, optional database with information of all directories, files remain in a database by directory
+
+def get_catalog_filename():
+    return os.path.join(CACHE_DIR, 'catalog.db')
+
+
+def is_catalog():
+    # Used after created by migrate_catalog, else .meta and .exclude files by directory
+    return os.path.exists(get_catalog_filename())
+
+
+def catalog_connect(filename=None):
+    conn = connect(filename or get_catalog_filename())
+    conn.execute('CREATE TABLE IF NOT EXISTS directories (hash TEXT PRIMARY KEY, path TEXT, meta TEXT, exclude TEXT)')
+    return conn
+
+
+def read_meta(meta, text):
+    if hasattr(meta, 'read_string'):
+        meta.read_string(text)
+    else:
+        meta.readfp(StringIO(text))
+
+
+def read_directory_files(hashid):
+    # Information of directory in .meta and .exclude files, as a catalog row
+    with open(os.path.join(CACHE_DIR, hashid + '.meta')) as fp:
+        text = fp.read()
+    exclude = ''
+    if os.path.exists(os.path.join(CACHE_DIR, hashid + '.exclude')):
+        with open(os.path.join(CACHE_DIR, hashid + '.exclude')) as fp:
+            exclude = fp.read()
+    meta = ConfigParser()
+    read_meta(meta, text)
+    return hashid, meta.get('META', 'path'), text, exclude
+
+
+def migrate_catalog():
+    # Catalog is created aside and renamed, so directories are in catalog or in its files if interrupted
+    hashids = sorted(filename[:-len('.meta')] for filename in os.listdir(CACHE_DIR) if filename.endswith('.meta'))
+    if not is_catalog():
+        tmp_filename = get_catalog_filename() + '.tmp'
+        with closing(catalog_connect(tmp_filename)) as conn:
+            conn.execute('DELETE FROM directories')
+            conn.executemany('INSERT INTO directories (hash, path, meta, exclude) VALUES (?, ?, ?, ?)',
+                             (read_directory_files(hashid) for hashid in hashids))
+            conn.commit()
+        os.rename(tmp_filename, get_catalog_filename())
+
+    # Files of directories are removed after in catalog, information already in catalog is newer
+    migrated = []
+    with closing(catalog_connect()) as conn:
+        for hashid in hashids:
+            row = read_directory_files(hashid)
+            conn.execute('INSERT OR IGNORE INTO directories (hash, path, meta, exclude) VALUES (?, ?, ?, ?)', row)
+            conn.commit()
+            for extension in ('.meta', '.exclude'):
+                if os.path.exists(os.path.join(CACHE_DIR, hashid + extension)):
+                    os.remove(os.path.join(CACHE_DIR, hashid + extension))
+            migrated.append(row[1])
+    return migrated
+
+
 # Directory
 
 def directory_by_hash(hashid, checkvalid=True):
+    if is_catalog():
+        with closing(catalog_connect()) as conn:
+            row = conn.execute('SELECT path, meta, exclude FROM directories WHERE hash = ?', (hashid,)).fetchone()
+        if row is None:
+            raise IOError('hash directory not found')
+        return Directory(row[0], checkvalid=checkvalid, row=row[1:])
     config = ConfigParser()
     if not config.read([os.path.join(CACHE_DIR, hashid + '.meta')]):
         raise IOError('hash directory not found')
@@ -64,11 +680,19 @@ def directory_by_hash(hashid, checkvalid=True):
 
 
 def directory_delete(hashid):
+    if is_catalog():
+        with closing(catalog_connect()) as conn:
+            conn.execute('DELETE FROM directories WHERE hash = ?', (hashid,))
+            conn.commit()
     for filename in [filename for filename in os.listdir(CACHE_DIR) if filename.startswith(hashid)]:
         os.remove(os.path.join(CACHE_DIR, filename))
 
 
 def directory_list():
+    if is_catalog():
+        with closing(catalog_connect()) as conn:
+            dirlist = [row[0] for row in conn.execute('SELECT path FROM directories')]
+        return sorted(dirlist, key=lambda x: x.lower())
     dirlist = []
     for filename in [filename for filename in os.listdir(CACHE_DIR) if filename.endswith('.meta')]:
         meta = ConfigParser()
@@ -78,8 +702,19 @@ def directory_list():
     return sorted(dirlist, key=lambda x: x.lower())
 
 
+def directory_all():
+    # Directories for a list, their databases are not opened
+    if is_catalog():
+        with closing(catalog_connect()) as conn:
+            rows = conn.execute('SELECT path, meta, exclude FROM directories').fetchall()
+        return [Directory(row[0], checkvalid=False, row=row[1:])
+                for row in sorted(rows, key=lambda row: row[0].lower())]
+    return [Directory(dirname, checkvalid=False) for dirname in directory_list()]
+
+
 class Directory(object):
-    def __init__(self, path, checkvalid=True):
+    def __init__(self, path, checkvalid=True, row=None):
+        # row is (meta, exclude) from catalog, to not read it again
         path = os.path.abspath(path)
         self._path = path
         if checkvalid and not self.is_valid():
@@ -88,8 +723,23 @@ class Directory(object):
         self._hashfile_prefix = os.path.join(CACHE_DIR, self.get_hash())
 
         self._meta = ConfigParser()
-        if os.path.exists(self.get_metafilename()):
-            self._meta.read([self.get_metafilename()])
+        # Options set by this object, other options are read again from saved meta by save_meta
+        self._options_changed = False
+        self.exclude = []
+        if is_catalog():
+            if row is None:
+                with closing(catalog_connect()) as conn:
+                    row = conn.execute('SELECT meta, exclude FROM directories WHERE hash = ?',
+                                       (self.get_hash(),)).fetchone()
+            if row is not None:
+                read_meta(self._meta, row[0] or '')
+                self.exclude = (row[1] or '').splitlines()
+        else:
+            if os.path.exists(self.get_metafilename()):
+                self._meta.read([self.get_metafilename()])
+            if os.path.exists(self.get_excludefilename()):
+                with open(self.get_excludefilename()) as fp:
+                    self.exclude = fp.read().splitlines()
         if not self._meta.has_section('META'):
             self._meta.add_section('META')
             self._meta.set('META', 'path', path)
@@ -98,6 +748,11 @@ class Directory(object):
         if not self._meta.has_section('options'):
             self._meta.add_section('options')
             self._meta.set('options', 'follow_link', 'False')
+            self._meta.set('options', 'hash_algorithm', HASH_ALGORITHM)
+            self.save_meta()
+        if not self._meta.has_option('options', 'hash_algorithm'):
+            # Caches created before this option use SHA-1
+            self._meta.set('options', 'hash_algorithm', 'sha1')
             self.save_meta()
         if not self._meta.has_section('duplicated'):
             self._meta.add_section('duplicated')
@@ -106,16 +761,21 @@ class Directory(object):
             self._meta.set('duplicated', 'size', '0')
             self.save_meta()
 
-        if os.path.exists(self.get_excludefilename()):
-            with open(self.get_excludefilename()) as fp:
-                self.exclude = fp.read().splitlines()
-        else:
-            self.exclude = []
-
-        self._conn = sqlite3.connect(self.get_dbfilename())
-        self._db = self._conn.cursor()
-        self._db.execute('CREATE TABLE IF NOT EXISTS files '
-                         '(filename TEXT PRIMARY KEY, mtime FLOAT, size INT, hash TEXT, exist INT)')
+        # Database is opened by first use
+        self._connection = None
+        self._cursor = None
+        self._uncommitted = 0
+        self._lastcommit = time.time()
+        self._run = None
+        # Files sent to workers and not written to database yet, and (files, bytes) listed by last update_tree
+        self.queue_depth = 0
+        self.listed = (0, 0)
+        # Bandwidth of its device, shared with directories updated at once (see scheduler)
+        self.bandwidth = None
+        # Ids of directories by path
+        self._dirs = {}
+        # Duplicated (hashs, files, size) of touched sizes before an update of some paths, None after a full update
+        self._touched = None
 
     def __str__(self):
         return self._path
@@ -137,17 +797,187 @@ class Directory(object):
         return self._hashfile_prefix + '.meta'
 
     # Database
+    def connect_database(self):
+        self._connection = connect(self.get_dbfilename())
+        self._cursor = self._connection.cursor()
+        self._cursor.execute('PRAGMA journal_mode = WAL')
+        self._cursor.execute('PRAGMA synchronous = NORMAL')
+        self._cursor.execute('PRAGMA cache_size = -65536')
+        self.migrate_database()
+
+    @property
+    def _conn(self):
+        if self._connection is None:
+            self.connect_database()
+        return self._connection
+
+    @property
+    def _db(self):
+        if self._cursor is None:
+            self.connect_database()
+        return self._cursor
+
     def save_database(self):
+        if self._run is not None:
+            self.save_run()
         self._conn.commit()
+        self._uncommitted = 0
+        self._lastcommit = time.time()
+
+    def save_database_batch(self):
+        # Commit only after COMMIT_FILES changes or COMMIT_SECONDS, limiting work lost if interrupted
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_FILES or time.time() - self._lastcommit >= COMMIT_SECONDS:
+            self.save_database()
+
+    def get_database_version(self):
+        self._db.execute('SELECT MAX(version) FROM schema_version')
+        return self._db.fetchone()[0] or 0
+
+    def migrate_database(self):
+        # Caches created before schema_version restart from first migration
+        self._db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY, applied TEXT)')
+        version = self.get_database_version()
+        if version > len(MIGRATIONS):
+            raise IOError('%s cache is from a newer version' % self._path)
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(self._db)
+            self._db.execute('INSERT INTO schema_version (version, applied) VALUES (?, ?)',
+                             (version, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            self.save_database()
 
     def optimize_database(self):
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         size_orig = os.path.getsize(self.get_dbfilename())
         self._db.execute('VACUUM')
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         size_opt = os.path.getsize(self.get_dbfilename())
         return (size_orig, size_opt, size_orig - size_opt)
 
+    # Files, stored by directory and name
+    def get_dir(self, path, create=False):
+        # Id of directory path, None if not in database and not created
+        if path in self._dirs:
+            return self._dirs[path]
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT id FROM dirs WHERE path = ?', (path,))
+        row = cursor.fetchone()
+        if row is None:
+            if not create:
+                return None
+            parent = self.get_dir(path.rpartition('/')[0], True) if path else None
+            cursor.execute('INSERT INTO dirs (parent, path) VALUES (?, ?)', (parent, path))
+            row = (cursor.lastrowid,)
+        if len(self._dirs) >= DIRS_CACHE:
+            self._dirs.clear()
+        self._dirs[path] = row[0]
+        return row[0]
+
+    def split_filename(self, filename):
+        dirname, _, name = filename.rpartition('/')
+        return self.get_dir(dirname), name
+
+    def get_ids(self, filename):
+        # Ids of filename and its hardlinks
+        dirid, name = self.split_filename(filename)
+        self._db.execute('SELECT id FROM files WHERE dir = ? AND name = ? UNION '
+                         'SELECT link.id FROM files JOIN files AS link '
+                         'ON link.dev = files.dev AND link.inode = files.inode '
+                         'WHERE files.dir = ? AND files.name = ?', (dirid, name, dirid, name))
+        return [row[0] for row in self._db.fetchall()]
+
+    def remove_empty_dirs(self, dirids=None):
+        # Directories without files and subdirectories, removed from deepest, only dirids and its parents if given
+        empty = ('NOT EXISTS (SELECT 1 FROM files WHERE files.dir = dirs.id) '
+                 'AND NOT EXISTS (SELECT 1 FROM dirs AS child WHERE child.parent = dirs.id)')
+        removed = 0
+        while dirids is None:
+            self._db.execute('DELETE FROM dirs WHERE %s' % empty)
+            if not self._db.rowcount:
+                break
+            removed += self._db.rowcount
+        while dirids:
+            parents = set()
+            for dirid in dirids:
+                self._db.execute('SELECT parent FROM dirs WHERE id = ? AND %s' % empty, (dirid,))
+                row = self._db.fetchone()
+                if row is not None:
+                    self._db.execute('DELETE FROM dirs WHERE id = ?', (dirid,))
+                    removed += 1
+                    parents.add(row[0])
+            dirids = parents - set([None])
+        if removed:
+            self._dirs.clear()
+        return removed
+
+    # Hash runs
+    def start_run(self):
+        self._db.execute('SELECT COUNT(*), IFNULL(SUM(size), 0) FROM '
+                         '(SELECT MAX(size) AS size FROM files WHERE exist = 1 GROUP BY %s)' % SQL_INODE)
+        files, size = self._db.fetchone()
+        self._db.execute('SELECT id, started, files_done, bytes_done, seconds FROM runs '
+                         'WHERE finished IS NULL ORDER BY id DESC LIMIT 1')
+        row = self._db.fetchone()
+        if row is None and not files:
+            return
+        if row is None:
+            row = (None, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 0, 0, 0.0)
+            self._db.execute('INSERT INTO runs (started) VALUES (?)', (row[1],))
+            row = (self._db.lastrowid,) + row[1:]
+        self._run = {
+            'id': row[0],
+            'started': row[1],
+            'finished': None,
+            'files_total': row[2] + files,
+            'bytes_total': row[3] + size,
+            'files_done': row[2],
+            'bytes_done': row[3],
+            'seconds': row[4],
+            'resumed': bool(row[2]),
+        }
+        self._run_clock = time.time()
+        self.save_database()
+
+    def save_run(self):
+        now = time.time()
+        self._run['seconds'] += now - self._run_clock
+        self._run_clock = now
+        self._db.execute('UPDATE runs SET finished = ?, files_total = ?, bytes_total = ?, files_done = ?, '
+                         'bytes_done = ?, seconds = ? WHERE id = ?',
+                         (self._run['finished'], self._run['files_total'], self._run['bytes_total'],
+                          self._run['files_done'], self._run['bytes_done'], self._run['seconds'], self._run['id']))
+
+    def finish_run(self):
+        if self._run is None:
+            return
+        self._run['finished'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.save_run()
+        self._run = None
+
+    def get_run(self):
+        # Current or last run, ETA from throughput measured in the run
+        if self._run is not None:
+            run = dict(self._run)
+            run['seconds'] += time.time() - self._run_clock
+        else:
+            self._db.execute('SELECT id, started, finished, files_total, bytes_total, files_done, bytes_done, '
+                             'seconds FROM runs ORDER BY id DESC LIMIT 1')
+            row = self._db.fetchone()
+            if row is None:
+                return None
+            run = dict(zip(('id', 'started', 'finished', 'files_total', 'bytes_total', 'files_done', 'bytes_done',
+                            'seconds'), row))
+            run['resumed'] = False
+        run['eta'] = None
+        if run['bytes_done'] and run['seconds']:
+            run['eta'] = (run['bytes_total'] - run['bytes_done']) / (run['bytes_done'] / run['seconds'])
+        return run
+
     # Exclude
     def save_exclude(self):
+        if is_catalog():
+            self.save_catalog('exclude', '\n'.join(self.exclude))
+            return
         with open(self.get_excludefilename(), 'w') as fp:
             fp.write('\n'.join(self.exclude))
 
@@ -172,129 +1002,913 @@ class Directory(object):
 
     def set_option_follow_link(self, value):
         self._meta.set('options', 'follow_link', 'yes' if value else 'no')
+        self._options_changed = True
 
     def is_option_follow_link(self):
         return self._meta.getboolean('options', 'follow_link')
 
+    def set_option_hash_algorithm(self, value):
+        new_hash(value)
+        if value != self.get_option_hash_algorithm():
+            # Hashs of different algorithms can not be compared, hash all files again
+            self._db.execute('UPDATE files SET hash = NULL, partialhash = NULL')
+            self._touched = None
+            self.update_candidates()
+            self.save_database()
+            self.update_completed()
+        self._meta.set('options', 'hash_algorithm', value)
+        self._options_changed = True
+
+    def get_option_hash_algorithm(self):
+        return self._meta.get('options', 'hash_algorithm')
+
+    def read_saved_meta(self):
+        meta = ConfigParser()
+        if is_catalog():
+            with closing(catalog_connect()) as conn:
+                row = conn.execute('SELECT meta FROM directories WHERE hash = ?', (self.get_hash(),)).fetchone()
+            read_meta(meta, (row[0] or '') if row is not None else '')
+        elif os.path.exists(self.get_metafilename()):
+            meta.read([self.get_metafilename()])
+        return meta
+
     def save_meta(self):
-        with open(self.get_metafilename(), 'w') as fp:
+        # Options changed by other object (as web while an update runs) are kept, not reverted to the ones read
+        if not self._options_changed:
+            saved = self.read_saved_meta()
+            if saved.has_section('options'):
+                for name, value in saved.items('options'):
+                    self._meta.set('options', name, value)
+        self._options_changed = False
+        if is_catalog():
+            fp = StringIO()
+            self._meta.write(fp)
+            self.save_catalog('meta', fp.getvalue())
+            return
+        # Written aside and renamed, a meta read at same time is never truncated
+        filename = self.get_metafilename()
+        with open(filename + '.tmp', 'w') as fp:
             self._meta.write(fp)
+        os.rename(filename + '.tmp', filename)
+
+    def save_catalog(self, column, value):
+        with closing(catalog_connect()) as conn:
+            conn.execute('INSERT OR IGNORE INTO directories (hash, path) VALUES (?, ?)', (self.get_hash(), self._path))
+            conn.execute('UPDATE directories SET %s = ? WHERE hash = ?' % column, (value, self.get_hash()))
+            conn.commit()
+
+    def update_completed(self):
+        # Kept in meta for list of directories without open their databases
+        self._db.execute('SELECT count(*) FROM files WHERE exist = 1')
+        self._meta.set('META', 'completed', 'no' if self._db.fetchone()[0] else 'yes')
 
     # Utils
     def is_completed(self):
-        self._db.execute('SELECT count(*) FROM files WHERE exist != 2')
-        return not self._db.fetchone()[0]
-
-    def is_file_in(self, filename):
-        hashfile = sha1_file(filename)
-        self._db.execute('SELECT filename FROM files WHERE hash = ?', (hashfile,))
-        return [os.path.join(self._path, row[0]) for row in self._db.fetchall()]
+        if not self._meta.has_option('META', 'completed'):
+            self.update_completed()
+            self.save_meta()
+        return self._meta.getboolean('META', 'completed')
+
+    def is_file_in(self, filename, size=None, digests=None):
+        # digests keep hashs of filename by algorithm, to check it in other directories without read it again
+        if size is None:
+            size = os.path.getsize(filename)
+        if digests is None:
+            digests = {}
+        algorithm = self.get_option_hash_algorithm()
+        self._db.execute('SELECT %s, files.partialhash, files.hash FROM %s WHERE files.size = ?' %
+                         (SQL_FILENAME, SQL_FILES), (size,))
+        rows = [(row[0], hash_from_blob(row[1]), hash_from_blob(row[2])) for row in self._db.fetchall()]
+
+        min_size = partial_hash_min_size()
+        if rows and min_size is not None and size > min_size:
+            if ('partial', algorithm) not in digests:
+                digests['partial', algorithm] = digest_partial(filename, algorithm)
+            candidates = []
+            for partial_filename, partialhash, hashrow in rows:
+                if partialhash is None and hashrow is None:
+                    try:
+                        partialhash = self.update_partial_hash(partial_filename)
+                    except OSError:
+                        # Deleted since last update, removed from cache by next update
+                        continue
+                if partialhash is None or partialhash == digests['partial', algorithm]:
+                    candidates.append((partial_filename, partialhash, hashrow))
+            rows = candidates
+        if not rows:
+            return []
+
+        if ('full', algorithm) not in digests:
+            digests['full', algorithm] = digest_file(filename, algorithm)
+        files = []
+        for partial_filename, _, hashrow in rows:
+            if hashrow is None:
+                try:
+                    hashrow = self.update_hash(partial_filename)
+                except OSError:
+                    # Deleted since last update, removed from cache by next update
+                    continue
+            if hashrow == digests['full', algorithm]:
+                files.append(os.path.join(self._path, partial_filename))
+        self.save_database()
+        return files
 
     def delete_file(self, filename):
-        self._db.execute('DELETE FROM files WHERE filename = ?', (filename,))
-        if self._db.rowcount:
-            os.remove(os.path.join(self._path, filename))
-            self.save_database()
+        self._db.execute('DELETE FROM files WHERE dir = ? AND name = ?', self.split_filename(filename))
+        if not self._db.rowcount:
+            return False
+        os.remove(os.path.join(self._path, filename))
+        self.save_database()
+        return True
 
-    def delete_duplicated_indir(self, dirname):
-        for _, _, files in self.get_duplicated():
-            for filename in [filename for filename in files if filename.startswith(dirname)]:
-                self.delete_file(filename)
+    def verify_links(self, files):
+        # files as from get_duplicated, lists of hardlinks read once, returned in groups of same content
+        links = dict((os.path.join(self._path, filenames[0]), filenames) for filenames in files)
+        return [[links[filename] for filename in group]
+                for group in compare_files([os.path.join(self._path, filenames[0]) for filenames in files])]
 
-    def list_files(self, dirname=''):
-        path = os.path.join(self._path, dirname)
-        follow_link = self.is_option_follow_link()
-        try:
-            filenames = sorted(os.listdir(path))
-        except OSError:
-            filenames = []
+    def reset_hash(self, filenames):
+        # Hashed again by next update
         for filename in filenames:
-            partial_filename = os.path.join(dirname, filename)
-            abs_filename = os.path.join(self._path, partial_filename)
+            self._db.execute('UPDATE files SET hash = NULL, partialhash = NULL, exist = 1 WHERE dir = ? AND name = ?',
+                             self.split_filename(filename))
+        self.save_database()
 
-            if partial_filename in self.exclude:
-                continue
+    def verify_duplicated(self, dirname=''):
+        # Yield (hash, size, groups of files with same content), files of hashs with different content are reset
+        for hashfile, size, files in list(self.get_duplicated(order='path', dirname=dirname)):
+            groups = self.verify_links(files)
+            if len(groups) > 1:
+                self.reset_hash([filename for links in files for filename in links])
+            yield hashfile, size, groups
+        self.update_duplicated()
 
-            if not follow_link and os.path.islink(abs_filename):
+    def delete_in_duplicated(self, files, selected, verify=True):
+        # Delete selected files of a duplicated hash, verified files only if a file with same content is kept
+        deleted = []
+        kept = []
+        groups = self.verify_links(files) if verify else [files]
+        if len(groups) > 1:
+            self.reset_hash([filename for links in files for filename in links])
+        for group in groups:
+            filenames = [filename for links in group for filename in links]
+            if verify and all(filename in selected for filename in filenames):
+                kept += [filename for filename in filenames if filename in selected]
                 continue
+            for filename in filenames:
+                if filename in selected:
+                    self.delete_file(filename)
+                    deleted.append(filename)
+        return deleted, kept
+
+    def delete_files(self, filenames, verify=True):
+        # Returns lists of deleted and kept files, verified files not duplicated are kept
+        if not verify:
+            deleted = [filename for filename in filenames if self.delete_file(filename)]
+            self.update_duplicated()
+            return deleted, []
+        selected = set(filenames)
+        deleted = []
+        kept = []
+        if not selected:
+            return deleted, kept
+        hashs = set()
+        for filename in selected:
+            self._db.execute('SELECT hash FROM files WHERE hash IS NOT NULL AND dir = ? AND name = ?',
+                             self.split_filename(filename))
+            hashs.update(bytes(row[0]) for row in self._db.fetchall())
+        for hashfile in sorted(hashs):
+            self._db.execute('SELECT files.hash, files.size, %s AS filename, files.dev, files.inode FROM %s '
+                             'WHERE files.hash = ? ORDER BY filename' % (SQL_FILENAME, SQL_FILES),
+                             (sqlite3.Binary(hashfile),))
+            for _, _, files in group_duplicated(self._db.fetchall()):
+                result = self.delete_in_duplicated(files, selected, verify)
+                deleted += result[0]
+                kept += result[1]
+        kept += sorted(selected - set(deleted) - set(kept))
+        self.update_duplicated()
+        return deleted, kept
+
+    def delete_duplicated_indir(self, dirname, verify=True):
+        deleted = []
+        kept = []
+        for _, _, files in list(self.get_duplicated()):
+            selected = set(filename for links in files for filename in links if filename.startswith(dirname))
+            if selected:
+                result = self.delete_in_duplicated(files, selected, verify)
+                deleted += result[0]
+                kept += result[1]
+        self.update_duplicated()
+        return deleted, kept
 
-            if os.path.isdir(abs_filename):
-                for f in self.list_files(partial_filename):
-                    yield f
-                continue
+    def list_files(self, dirname='', jobs=1):
+        follow_link = self.is_option_follow_link()
+        scan = partial(scan_directory, follow_link=follow_link)
+        is_excluded = compile_exclude(self.exclude)
+        visited = set()
+
+        # Listing of a path inside directory, can be a file or not exist anymore
+        if dirname:
+            abs_dirname = os.path.join(self._path, dirname)
+            if is_excluded(dirname, os.path.basename(dirname)):
+                return
+            if not follow_link and os.path.islink(abs_dirname):
+                return
+            try:
+                stat = os.stat(abs_dirname)
+            except OSError:
+                return
+            if not stat_mode.S_ISDIR(stat.st_mode):
+                yield dirname, mtime_ns(stat), stat.st_size, stat.st_dev, stat.st_ino or None
+                return
+
+        if follow_link:
+            stat = os.stat(os.path.join(self._path, dirname))
+            visited.add((stat.st_dev, stat.st_ino))
+
+        # Directories of same level are listed in parallel, useful in filesystems with high latency
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        dirnames = [dirname]
+        try:
+            while dirnames:
+                abs_dirnames = [os.path.join(self._path, d) for d in dirnames]
+                listings = pool.imap(scan, abs_dirnames) if pool else (scan(d) for d in abs_dirnames)
+                subdirnames = []
+                for parent, entries in zip(dirnames, listings):
+                    for filename, is_dir, stat in entries:
+                        partial_filename = os.path.join(parent, filename)
+
+                        # Excluded directories are never listed
+                        if is_excluded(partial_filename, filename):
+                            continue
+
+                        if is_dir:
+                            if follow_link:
+                                if (stat.st_dev, stat.st_ino) in visited:
+                                    continue
+                                visited.add((stat.st_dev, stat.st_ino))
+                            subdirnames.append(partial_filename)
+                            continue
+
+                        # Some systems do not have inode number
+                        yield partial_filename, mtime_ns(stat), stat.st_size, stat.st_dev, stat.st_ino or None
+                dirnames = subdirnames
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def duplicated_stats(self, touched=False):
+        # (hashs, files, size) of duplicated, of touched sizes only if asked
+        query, params = self.duplicated_query(touched=touched)
+        self._db.execute('SELECT COUNT(*), IFNULL(SUM(files), 0), IFNULL(SUM(wasted), 0) FROM (%s)' % query, params)
+        return self._db.fetchone()
+
+    def update_duplicated(self, touched=False):
+        # Files of a hash have the same size, so only duplicated of touched sizes change by an update of some paths
+        stats = self.duplicated_stats(touched)
+        if touched:
+            stats = [self._meta.getint('duplicated', key) + new - old
+                     for key, old, new in zip(('hash', 'files', 'size'), self._touched, stats)]
+        self._touched = None
+
+        self._meta.set('duplicated', 'hash', str(stats[0]))
+        self._meta.set('duplicated', 'files', str(stats[1]))
+        self._meta.set('duplicated', 'size', str(stats[2]))
+        self.update_completed()
+        self.save_meta()
 
-            file_stat = os.stat(abs_filename)
-            yield partial_filename, file_stat.st_mtime, file_stat.st_size
+    def update_candidates(self, touched=False):
+        # Only files of touched sizes if asked, the others did not change since last update
+        scope = SQL_TOUCHED if touched else '1'
+        # Hash of a hardlink is kept only while it has the mtime and size of the file
+        link = ('SELECT %s FROM files AS link WHERE link.dev = files.dev AND link.inode = files.inode '
+                'AND link.mtime = files.mtime AND link.size = files.size AND link.hash IS NOT NULL')
+        self._db.execute('UPDATE files SET exist = 2, hash = (%s) WHERE files.hash IS NULL AND %s AND EXISTS (%s)' %
+                         (link % 'link.hash', scope, link % '1'))
+        self._db.execute('UPDATE files SET exist = CASE WHEN '
+                         'size IN (SELECT size FROM files WHERE %(scope)s '
+                         'GROUP BY size HAVING COUNT(DISTINCT %(inode)s) > 1) AND '
+                         '(partialhash IS NULL OR partialhash IN (SELECT partialhash FROM files '
+                         'WHERE partialhash IS NOT NULL AND %(scope)s GROUP BY partialhash '
+                         'HAVING COUNT(DISTINCT %(inode)s) > 1)) '
+                         'THEN 1 ELSE 3 END '
+                         'WHERE files.hash IS NULL AND %(scope)s' % {'inode': SQL_INODE, 'scope': scope})
 
-    def update_duplicated(self):
-        d_hash = 0
-        d_files = 0
-        d_size = 0
+    # Steps
+    def tree_rows(self, dirname='', jobs=1):
+        # Files of list_files by directory id and name, directories are created by first file
+        for row in self.list_files(dirname, jobs):
+            parent, _, name = row[0].rpartition('/')
+            yield (self.get_dir(parent, True), name) + row[1:]
+
+    def update_tree(self, jobs=1, dirnames=None):
+        # dirnames limit the update to these paths, files or directories, inside directory
+        if dirnames is None or '' in dirnames:
+            dirnames = ['']
+        touched = dirnames != ['']
+        if touched and self._touched is not None:
+            # Touched sizes of an update not followed by a hash run
+            self.update_duplicated(True)
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS tree '
+                         '(dir INT, name TEXT, mtime INT, size INT, dev INT, inode INT, PRIMARY KEY (dir, name))')
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS changed '
+                         '(id INTEGER PRIMARY KEY, mtime INT, size INT, dev INT, inode INT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS temp.changed_inode ON changed (dev, inode)')
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS deleted (id INTEGER PRIMARY KEY)')
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS touched (size INTEGER PRIMARY KEY)')
+        for table in ('tree', 'changed', 'deleted', 'touched'):
+            self._db.execute('DELETE FROM %s' % table)
+        for dirname in dirnames:
+            self._db.executemany('INSERT OR REPLACE INTO tree (dir, name, mtime, size, dev, inode) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 self.tree_rows(dirname, jobs))
+        self._db.execute('SELECT COUNT(*), IFNULL(SUM(size), 0) FROM tree')
+        self.listed = self._db.fetchone()
+
+        # Deleted file, the file dirname or directories in range of paths starting with dirname/ ('0' follows '/')
+        for dirname in dirnames:
+            if not dirname:
+                self._db.execute('INSERT INTO deleted SELECT id FROM files WHERE NOT EXISTS '
+                                 '(SELECT 1 FROM tree WHERE tree.dir = files.dir AND tree.name = files.name)')
+            else:
+                dirid, name = self.split_filename(dirname)
+                self._db.execute('INSERT OR IGNORE INTO deleted SELECT id FROM files WHERE (dir = ? AND name = ? '
+                                 'OR dir IN (SELECT id FROM dirs WHERE path = ? OR path >= ? AND path < ?)) '
+                                 'AND NOT EXISTS (SELECT 1 FROM tree '
+                                 'WHERE tree.dir = files.dir AND tree.name = files.name)',
+                                 (dirid, name, dirname, dirname + '/', dirname + '0'))
+
+        # Sizes that can have new or lost duplicated, before and after, and of files still pending
+        if touched:
+            self._db.execute('INSERT OR IGNORE INTO touched SELECT size FROM tree UNION SELECT files.size '
+                             'FROM tree JOIN files ON files.dir = tree.dir AND files.name = tree.name '
+                             'UNION SELECT size FROM files WHERE id IN (SELECT id FROM deleted) '
+                             'UNION SELECT size FROM files WHERE exist = 1')
+            self._touched = self.duplicated_stats(True)
+        else:
+            self._touched = None
+
+        # Update file, and its hardlinks not listed, they have the same content
+        self._db.execute('INSERT INTO changed (id, mtime, size, dev, inode) '
+                         'SELECT files.id, tree.mtime, tree.size, tree.dev, tree.inode FROM tree '
+                         'JOIN files ON files.dir = tree.dir AND files.name = tree.name '
+                         'WHERE files.mtime IS NULL OR ABS(tree.mtime - files.mtime) >= ? OR tree.size != files.size',
+                         (MTIME_TOLERANCE,))
+        self._db.execute('INSERT OR IGNORE INTO changed (id, mtime, size, dev, inode) '
+                         'SELECT files.id, changed.mtime, changed.size, changed.dev, changed.inode FROM changed '
+                         'JOIN files ON files.dev = changed.dev AND files.inode = changed.inode')
+        self._db.execute('UPDATE files SET '
+                         'mtime = (SELECT mtime FROM changed WHERE changed.id = files.id), '
+                         'size = (SELECT size FROM changed WHERE changed.id = files.id), '
+                         'hash = NULL, exist = 1, partialhash = NULL, fingerprint = NULL, blocks = NULL '
+                         'WHERE id IN (SELECT id FROM changed)')
+        update = self._db.rowcount
+
+        # Update inode, a hardlink can replace the file keeping mtime and size, and mtime inside tolerance
+        self._db.execute('UPDATE files SET '
+                         'dev = (SELECT dev FROM tree WHERE tree.dir = files.dir AND tree.name = files.name), '
+                         'inode = (SELECT inode FROM tree WHERE tree.dir = files.dir AND tree.name = files.name), '
+                         'mtime = (SELECT mtime FROM tree WHERE tree.dir = files.dir AND tree.name = files.name) '
+                         'WHERE id IN (SELECT files.id FROM tree '
+                         'JOIN files ON files.dir = tree.dir AND files.name = tree.name '
+                         'WHERE files.inode IS NULL OR tree.inode != files.inode OR tree.dev != files.dev OR '
+                         'tree.mtime != files.mtime)')
+
+        # New file
+        self._db.execute('INSERT INTO files (dir, name, mtime, size, hash, exist, dev, inode) '
+                         'SELECT dir, name, mtime, size, NULL, 1, dev, inode FROM tree WHERE NOT EXISTS '
+                         '(SELECT 1 FROM files WHERE files.dir = tree.dir AND files.name = tree.name)')
+        insert = self._db.rowcount
+
+        # Deleted file, only its directories can be empty after an update of some paths
+        dirids = None
+        if touched:
+            self._db.execute('SELECT DISTINCT dir FROM files WHERE id IN (SELECT id FROM deleted)')
+            dirids = [row[0] for row in self._db.fetchall()]
+        self._db.execute('DELETE FROM files WHERE id IN (SELECT id FROM deleted)')
+        delete = self._db.rowcount
+        for table in ('tree', 'changed', 'deleted'):
+            self._db.execute('DELETE FROM %s' % table)
+        self.remove_empty_dirs(dirids)
 
-        for hashfile, size, files in self.get_duplicated():
-            d_hash += 1
-            files_len = len(files)
-            d_files += files_len
-            d_size += (files_len - 1) * size
+        # Files with unique size can not be duplicated, only hash them when a file with same size appear
+        self.update_candidates(touched)
+        self.save_database()
+        self.update_completed()
+        self.save_meta()
+        return insert, update, delete
 
-        self._meta.set('duplicated', 'hash', str(d_hash))
-        self._meta.set('duplicated', 'files', str(d_files))
-        self._meta.set('duplicated', 'size', str(d_size))
+    def partial_hash_for_update(self, touched=False):
+        min_size = partial_hash_min_size()
+        if min_size is None:
+            return []
+        scope = SQL_TOUCHED if touched else '1'
+        self._db.execute('SELECT MIN(%(filename)s) FROM %(files)s WHERE files.partialhash IS NULL AND files.size > ? '
+                         'AND %(scope)s AND files.size IN (SELECT size FROM files WHERE %(scope)s '
+                         'GROUP BY size HAVING COUNT(DISTINCT %(inode)s) > 1) '
+                         'GROUP BY %(inode)s' % {
+                             'filename': SQL_FILENAME,
+                             'files': SQL_FILES,
+                             'scope': scope,
+                             'inode': SQL_INODE,
+                         }, (min_size,))
+        return [row[0] for row in self._db.fetchall()]
+
+    def pages_for_update(self):
+        touched = self._touched is not None
+        for filename in self.partial_hash_for_update(touched):
+            self.update_partial_hash(filename)
+        self.update_candidates(touched)
+        self.save_database()
+        self.start_run()
+        # Pending files are read by pages after the last file id, hashed files and its links leave exist = 1,
+        # so a link of a file is only pending in the same page
+        fileid = 0
+        while True:
+            self._db.execute('SELECT files.id, %s, files.dev, files.inode FROM %s '
+                             'WHERE files.exist = 1 AND files.id > ? ORDER BY files.id LIMIT ?' %
+                             (SQL_FILENAME, SQL_FILES), (fileid, PENDING_FILES))
+            rows = self._db.fetchall()
+            if not rows:
+                return
+            inodes = set()
+            filenames = []
+            for _, filename, dev, inode in rows:
+                if inode is not None and (dev, inode) in inodes:
+                    continue
+                inodes.add((dev, inode))
+                filenames.append(filename)
+            yield filenames
+            fileid = rows[-1][0]
+
+    def files_for_update(self):
+        for filenames in self.pages_for_update():
+            for filename in filenames:
+                yield filename
+
+    def finish_update(self):
+        self.finish_run()
+        self.save_database()
+        self.now_lastupdate()
+        self.update_duplicated(self._touched is not None)
         self.save_meta()
 
-    # Steps
-    def update_tree(self):
-        insert = 0
-        update = 0
-        self._db.execute('UPDATE files SET exist = 0')
-        for partial_filename, mtime, size in self.list_files():
-            self._db.execute('SELECT mtime, size FROM files WHERE filename = ?', (partial_filename,))
-            row = self._db.fetchone()
+    def stop_update(self):
+        # Interrupted update, hashed files are kept and the run is resumed by next update
+        self.save_database()
+        self.update_duplicated(self._touched is not None)
 
-            # New file
-            if row is None:
-                self._db.execute('INSERT INTO files (filename, mtime, size, hash, exist) VALUES (?, NULL, ?, NULL, 1)',
-                                 (partial_filename, size))
-                insert += 1
-                continue
+    def hash_for_update(self):
+        completed = False
+        try:
+            for filename in self.files_for_update():
+                yield filename
+            completed = True
+        finally:
+            if completed:
+                self.finish_update()
+            else:
+                self.stop_update()
+
+    def throttle(self, filename):
+        # Wait for the size of file in bandwidth before it is read
+        if self.bandwidth is not None:
+            self.bandwidth.consume(file_size(filename))
+        return filename
+
+    def map_files(self, function, filenames, pool=None, throttle=False):
+        # (filename, function of its path) of each file, by workers of pool (see files_pool) if given
+        abs_filenames = (os.path.join(str(self), filename) for filename in filenames)
+        if throttle:
+            # Pool takes files from the generator as sent to workers, so bandwidth also holds them
+            abs_filenames = (self.throttle(filename) for filename in abs_filenames)
+        if pool is not None:
+            results = pool.imap(function, abs_filenames)
+        else:
+            results = (function(filename) for filename in abs_filenames)
+        # Workers only read files, database is written by the caller in this thread
+        for i, (filename, result) in enumerate(zip(filenames, results)):
+            self.queue_depth = len(filenames) - i - 1 if pool is not None else 0
+            yield filename, result
+
+    def update_hash_parallel(self, jobs=1, processes=False):
+        hash_function = partial(hash_file, algorithm=self.get_option_hash_algorithm())
+        completed = False
+        try:
+            with files_pool(jobs, processes) as pool:
+                for filenames in self.pages_for_update():
+                    for filename, result in self.map_files(hash_function, filenames, pool, throttle=True):
+                        self.update_hash(filename, result)
+                        yield filename
+            completed = True
+        finally:
+            if completed:
+                self.finish_update()
+            else:
+                self.stop_update()
+
+    def get_links(self, filename):
+        dirid, name = self.split_filename(filename)
+        self._db.execute('SELECT %s FROM files AS file '
+                         'JOIN files ON files.dev = file.dev AND files.inode = file.inode '
+                         'JOIN dirs ON dirs.id = files.dir '
+                         'WHERE file.dir = ? AND file.name = ? AND files.id != file.id' % SQL_FILENAME, (dirid, name))
+        return [row[0] for row in self._db.fetchall()]
+
+    def update_partial_hash(self, filename):
+        if self.bandwidth is not None:
+            self.bandwidth.consume(2 * PARTIAL_HASH_BLOCK)
+        partialhash = digest_partial(os.path.join(str(self), filename), self.get_option_hash_algorithm())
+        for fileid in self.get_ids(filename):
+            self._db.execute('UPDATE files SET partialhash = ? WHERE id = ?', (hash_to_blob(partialhash), fileid))
+        return partialhash
+
+    def update_hash(self, filename, result=None):
+        if result is None:
+            result = hash_file(self.throttle(os.path.join(str(self), filename)), self.get_option_hash_algorithm())
+        mtime, size, hashfile = result
+        for fileid in self.get_ids(filename):
+            self._db.execute('UPDATE files SET mtime = ?, size = ?, hash = ?, exist = 2 WHERE id = ?',
+                             (mtime, size, hash_to_blob(hashfile), fileid))
+        if self._run is not None:
+            self._run['files_done'] += 1
+            self._run['bytes_done'] += size
+        self.save_database_batch()
+        return hashfile
+
+    def fingerprint_for_update(self):
+        self._db.execute('SELECT MIN(%s) FROM %s WHERE files.fingerprint IS NULL AND files.size >= ? '
+                         'GROUP BY %s ORDER BY 1' % (SQL_FILENAME, SQL_FILES, SQL_INODE), (SIMILAR_MIN_SIZE,))
+        return [row[0] for row in self._db.fetchall()]
+
+    def update_fingerprint(self, filename, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = fingerprint_file(os.path.join(str(self), filename))
+        for fileid in self.get_ids(filename):
+            self._db.execute('UPDATE files SET fingerprint = ? WHERE id = ?', (sqlite3.Binary(fingerprint), fileid))
+        self.save_database_batch()
+        return fingerprint
+
+    def update_fingerprint_parallel(self, jobs=1, processes=False):
+        try:
+            with files_pool(jobs, processes) as pool:
+                for filename, fingerprint in self.map_files(fingerprint_file, self.fingerprint_for_update(), pool):
+                    self.update_fingerprint(filename, fingerprint)
+                    yield filename
+        finally:
+            self.save_database()
 
-            # Update file
-            if mtime != row[0] or size != row[1]:
-                self._db.execute('UPDATE files SET mtime = NULL, size = ?, hash = NULL, exist = 1 WHERE filename = ?',
-                                 (size, partial_filename))
-                update += 1
+    def get_similar(self, threshold=None, dirname=''):
+        # Groups of [(hardlinks, size, hash, similarity with first file)], by LSH of fingerprints in a temp table,
+        # files of a band in same bucket are compared with few files of the bucket instead of all pairs
+        if threshold is None:
+            threshold = SIMILAR_THRESHOLD
+        rows = lsh_rows(threshold, SIMILAR_BINS)
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS bands (band INT, key BLOB, file INT, filename TEXT)')
+        self._db.execute('DELETE FROM bands')
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT MIN(%s), files.id, files.fingerprint FROM %s WHERE files.fingerprint IS NOT NULL '
+                       'GROUP BY %s' % (SQL_FILENAME, SQL_FILES, SQL_INODE))
+        self._db.executemany('INSERT INTO bands (band, key, file, filename) VALUES (?, ?, ?, ?)',
+                             ((band, sqlite3.Binary(key), fileid, filename)
+                              for filename, fileid, fingerprint in cursor
+                              for band, key in lsh_keys(fingerprint, rows)))
+        self._db.execute('CREATE INDEX IF NOT EXISTS temp.bands_key ON bands (band, key)')
+
+        parent = {}
+
+        def find(filename):
+            while parent[filename] != filename:
+                parent[filename] = parent[parent[filename]]
+                filename = parent[filename]
+            return filename
+
+        fingerprints = {}
+        bucket = None
+        leaders = []
+        cursor.execute('SELECT bands.band, bands.key, bands.filename, files.fingerprint FROM bands '
+                       'JOIN (SELECT band, key FROM bands GROUP BY band, key HAVING COUNT(*) > 1) AS buckets '
+                       'ON buckets.band = bands.band AND buckets.key = bands.key '
+                       'JOIN files ON files.id = bands.file '
+                       'ORDER BY bands.band, bands.key, bands.filename')
+        for band, key, filename, fingerprint in cursor:
+            if (band, key) != bucket:
+                bucket = (band, key)
+                leaders = []
+            fingerprints[filename] = bytes(fingerprint)
+            parent.setdefault(filename, filename)
+            for leader in leaders:
+                if similarity(fingerprints[leader], fingerprints[filename]) >= threshold:
+                    parent[find(filename)] = find(leader)
+                    break
+            else:
+                if len(leaders) < 16:
+                    leaders.append(filename)
+        self._db.execute('DELETE FROM bands')
+
+        groups = {}
+        for filename in parent:
+            groups.setdefault(find(filename), []).append(filename)
+        dirname = dirname.rstrip('/') + '/' if dirname else ''
+        result = []
+        for filenames in groups.values():
+            if len(filenames) < 2 or not any(filename.startswith(dirname) for filename in filenames):
                 continue
+            filenames.sort()
+            group = []
+            for filename in filenames:
+                self._db.execute('SELECT size, hash FROM files WHERE dir = ? AND name = ?',
+                                 self.split_filename(filename))
+                size, hashfile = self._db.fetchone()
+                hashfile = hash_from_blob(hashfile)
+                value = similarity(fingerprints[filenames[0]], fingerprints[filename])
+                group.append((sorted([filename] + self.get_links(filename)), size, hashfile, value))
+            result.append(group)
+        return sorted(result, key=lambda group: (-sum(row[1] for row in group), group[0][0]))
+
+    def blocks_for_update(self, min_size=BLOCK_FILE_MIN):
+        self._db.execute('SELECT MIN(%s) FROM %s WHERE files.blocks IS NULL AND files.size > ? '
+                         'GROUP BY %s ORDER BY 1' % (SQL_FILENAME, SQL_FILES, SQL_INODE),
+                         (max(BLOCK_MIN, min_size - 1),))
+        return [row[0] for row in self._db.fetchall()]
+
+    def update_blocks(self, filename, blocks=None):
+        if blocks is None:
+            blocks = block_file(os.path.join(str(self), filename))
+        for fileid in self.get_ids(filename):
+            self._db.execute('UPDATE files SET blocks = ? WHERE id = ?', (sqlite3.Binary(blocks), fileid))
+        self.save_database_batch()
+        return blocks
+
+    def update_blocks_parallel(self, jobs=1, processes=False, min_size=BLOCK_FILE_MIN):
+        try:
+            with files_pool(jobs, processes) as pool:
+                for filename, blocks in self.map_files(block_file, self.blocks_for_update(min_size), pool):
+                    self.update_blocks(filename, blocks)
+                    yield filename
+        finally:
+            self.save_database()
 
-            # Unmodified file
-            self._db.execute('UPDATE files SET exist = 2 WHERE filename = ?', (partial_filename,))
+    def get_blocks_report(self, depth=1, limit=20, min_size=BLOCK_FILE_MIN):
+        # Bytes reclaimable by dedup of chunks, a chunk is kept in the first file with it (by name),
+        # its other copies are reclaimable by the pair of files and by the subtree of the copy
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS blocks (digest BLOB, size INT, filename TEXT)')
+        self._db.execute('DELETE FROM blocks')
+        cursor = self._conn.cursor()
+        # Files chunked before with a lower min_size are not counted
+        cursor.execute('SELECT MIN(%s), files.blocks FROM %s WHERE files.blocks IS NOT NULL AND files.size >= ? '
+                       'GROUP BY %s' % (SQL_FILENAME, SQL_FILES, SQL_INODE), (min_size,))
+        self._db.executemany('INSERT INTO blocks (digest, size, filename) VALUES (?, ?, ?)',
+                             ((sqlite3.Binary(digest), size, filename)
+                              for filename, blocks in cursor
+                              for digest, size in block_entries(blocks)))
+        self._db.execute('CREATE INDEX IF NOT EXISTS temp.blocks_digest ON blocks (digest, filename)')
+
+        report = {'depth': depth}
+        self._db.execute('SELECT COUNT(DISTINCT filename), COUNT(*), IFNULL(SUM(size), 0) FROM blocks')
+        report['files'], report['chunks'], report['bytes'] = self._db.fetchone()
+        self._db.execute('SELECT IFNULL(SUM(size * (copies - 1)), 0) FROM '
+                         '(SELECT MAX(size) AS size, COUNT(*) AS copies FROM blocks GROUP BY digest)')
+        report['reclaimable'] = self._db.fetchone()[0]
+
+        # Copies of chunks by file, with the first file of each chunk
+        cursor.execute('SELECT copies.filename, owners.filename, '
+                       'SUM(copies.size * (copies.copies - (copies.filename = owners.filename))) FROM '
+                       '(SELECT digest, filename, MAX(size) AS size, COUNT(*) AS copies FROM blocks '
+                       'GROUP BY digest, filename) AS copies '
+                       'JOIN (SELECT digest, MIN(filename) AS filename FROM blocks GROUP BY digest) AS owners '
+                       'ON owners.digest = copies.digest '
+                       'GROUP BY copies.filename, owners.filename HAVING SUM(copies.size * '
+                       '(copies.copies - (copies.filename = owners.filename))) > 0')
+        pairs = []
+        subtrees = {}
+        for filename, owner, size in cursor:
+            pairs.append((filename, owner, size))
+            subtree = '/'.join(filename.split('/')[:-1][:depth]) or '.'
+            subtrees[subtree] = subtrees.get(subtree, 0) + size
+        self._db.execute('DELETE FROM blocks')
+        report['pairs'] = sorted(pairs, key=lambda pair: (-pair[2], pair[0], pair[1]))[:limit]
+        report['subtrees'] = sorted(subtrees.items(), key=lambda subtree: (-subtree[1], subtree[0]))
+        return report
+
+    def duplicated_query(self, dirname='', path=False, touched=False):
+        # Duplicated hashs, with a file inside dirname if present, path of first file only if asked
+        where = 'AND %s ' % SQL_TOUCHED if touched else ''
+        having = ''
+        params = ()
+        if dirname:
+            dirname = dirname.rstrip('/')
+            having = 'AND SUM(dirs.path = ? OR dirs.path >= ? AND dirs.path < ?) > 0 '
+            params = (dirname, dirname + '/', dirname + '0')
+        return ('SELECT files.hash AS hash, MAX(files.size) AS size, '
+                '(COUNT(DISTINCT %(inode)s) - 1) * MAX(files.size) AS wasted, COUNT(*) AS files, '
+                '%(path)s AS path FROM %(files)s WHERE files.hash IS NOT NULL %(where)sGROUP BY files.hash '
+                'HAVING COUNT(DISTINCT %(inode)s) > 1 %(having)s' % {
+                    'inode': SQL_INODE,
+                    'path': 'MIN(%s)' % SQL_FILENAME if path else 'NULL',
+                    'files': SQL_FILES if path or dirname else 'files',
+                    'where': where,
+                    'having': having,
+                }), params
+
+    def count_duplicated(self, dirname=''):
+        query, params = self.duplicated_query(dirname)
+        self._db.execute('SELECT COUNT(*) FROM (%s)' % query, params)
+        return self._db.fetchone()[0]
+
+    def get_duplicated(self, order='size', reverse=False, limit=-1, offset=0, dirname=''):
+        if order not in ('size', 'wasted', 'path'):
+            raise ValueError('invalid order %s' % order)
+        query, params = self.duplicated_query(dirname, order == 'path')
+        # Own cursor, rows are read while the caller can use the database
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT lower(hex(files.hash)), files.size, %(filename)s AS filename, files.dev, files.inode '
+                       'FROM %(files)s '
+                       'JOIN (%(query)s ORDER BY %(order)s %(direction)s, hash LIMIT ? OFFSET ?) AS duplicated '
+                       'ON files.hash = duplicated.hash '
+                       'ORDER BY duplicated.%(order)s %(direction)s, files.hash, filename' % {
+                           'filename': SQL_FILENAME,
+                           'files': SQL_FILES,
+                           'query': query,
+                           'order': order,
+                           'direction': 'DESC' if reverse else 'ASC',
+                       }, params + (limit, offset))
+        return group_duplicated(cursor)
+
+
+def list_probe_files(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filename = os.path.join(dirpath, filename)
+            if os.path.isfile(filename) and not os.path.islink(filename):
+                yield filename
+
+
+def find_files(filenames, directories):
+    # Directories are opened once for all files, files are read only if a cache has a file with its size
+    for filename in filenames:
+        digests = {}
+        files = []
+        try:
+            size = os.path.getsize(filename)
+            for directory in directories:
+                files += directory.is_file_in(filename, size, digests)
+        except OSError:
+            # Probe removed while checking, the next ones are still checked
+            continue
+        yield filename, files
 
-        self._db.execute('DELETE FROM files WHERE exist = 0')
-        delete = self._db.rowcount
-        self.save_database()
-        return insert, update, delete
 
-    def hash_for_update(self):
-        self._db.execute('SELECT filename FROM files WHERE exist = 1')
-        for filename in self._db.fetchall():
-            yield filename[0]
-        self.now_lastupdate()
-        self.update_duplicated()
-        self.save_meta()
+# Global index
 
-    def update_hash(self, filename):
-        abs_filename = os.path.join(str(self), filename)
-        stat = os.stat(abs_filename)
-        self._db.execute('UPDATE files SET mtime = ?, size = ?, hash = ?, exist = 2 WHERE filename = ?',
-                         (stat.st_mtime, stat.st_size, sha1_file(abs_filename), filename))
-        self.save_database()
+def get_global_filename():
+    return os.path.join(CACHE_DIR, 'global.db')
+
+
+class GlobalIndex(object):
+    """Duplicated files between directories, from the hashs in their caches.
 
-    def get_duplicated(self):
-        self._db.execute('SELECT hash, COUNT(hash) FROM files GROUP BY hash ORDER BY size ASC')
-        for row in self._db.fetchall():
-            if row[1] > 1:
-                self._db.execute('SELECT filename, size FROM files WHERE hash = ? ORDER BY filename ASC', (row[0],))
-                files = self._db.fetchall()
-                yield row[0], files[0][1], [f[0] for f in files]
+    The index is a temporary database, or kept in filename to be read again
+    without dirnames (as by pages of the web version) until built again.
+    """
+
+    def __init__(self, dirnames=None, filename=''):
+        if dirnames is None:
+            self._conn = connect(filename)
+            self._db = self._conn.cursor()
+            self._db.execute('SELECT path FROM roots ORDER BY root')
+            self._directories = [Directory(row[0], checkvalid=False) for row in self._db.fetchall()]
+            return
+        self._directories = [Directory(dirname) for dirname in dirnames]
+
+        # Built in other file, so readers of filename have the previous index until it is complete
+        tmpfilename = filename + '.tmp' if filename else ''
+        if tmpfilename and os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+        # Temporary database in disk, only rows of sizes in more than one file are kept
+        self._conn = connect(tmpfilename)
+        self._db = self._conn.cursor()
+        self._db.execute('CREATE TABLE roots (root INT PRIMARY KEY, path TEXT)')
+        self._db.executemany('INSERT INTO roots (root, path) VALUES (?, ?)',
+                             [(root, str(directory)) for root, directory in enumerate(self._directories)])
+        self._db.execute('CREATE TABLE files (root INT, filename TEXT, size INT, hash TEXT, algorithm TEXT, '
+                         'dev INT, inode INT, key TEXT, partialhash TEXT)')
+        for root, directory in enumerate(self._directories):
+            # Opened before attached, migrating its database
+            directory.get_database_version()
+            self._db.execute('ATTACH DATABASE ? AS cache', (directory.get_dbfilename(),))
+            self._db.execute('INSERT INTO files SELECT ?, %(filename)s AS filename, files.size, '
+                             'CASE WHEN files.hash IS NOT NULL THEN lower(hex(files.hash)) END, ?, files.dev, '
+                             "files.inode, IFNULL(files.dev || ':' || files.inode, ? || ':' || %(filename)s), "
+                             'CASE WHEN files.partialhash IS NOT NULL THEN lower(hex(files.partialhash)) END '
+                             'FROM cache.files AS files JOIN cache.dirs AS dirs ON dirs.id = files.dir' % {
+                                 'filename': SQL_FILENAME,
+                             }, (root, directory.get_option_hash_algorithm(), root))
+            self._conn.commit()
+            self._db.execute('DETACH DATABASE cache')
+        self._db.execute('DELETE FROM files WHERE size NOT IN '
+                         '(SELECT size FROM files GROUP BY size HAVING COUNT(DISTINCT key) > 1)')
+        self._db.execute('CREATE INDEX files_hash ON files (algorithm, hash)')
+        self._db.execute('CREATE INDEX files_key ON files (key)')
+        self._db.execute('CREATE INDEX files_size ON files (size)')
+        self._conn.commit()
+        if filename:
+            self._conn.close()
+            os.rename(tmpfilename, filename)
+            self._conn = connect(filename)
+            self._db = self._conn.cursor()
+
+    def get_directories(self):
+        return self._directories
+
+    def count_duplicated(self):
+        self._db.execute('SELECT COUNT(*) FROM (SELECT 1 FROM files WHERE hash IS NOT NULL '
+                         'GROUP BY algorithm, hash HAVING COUNT(DISTINCT key) > 1)')
+        return self._db.fetchone()[0]
+
+    def remove_file(self, directory, filename):
+        # Deleted since last update of its directory, removed from its cache by next update
+        self._db.execute('DELETE FROM files WHERE root = ? AND filename = ?',
+                         (self._directories.index(directory), filename))
+        self._conn.commit()
+
+    def partial_hash_for_update(self):
+        min_size = partial_hash_min_size()
+        if min_size is None:
+            return []
+        self._db.execute('SELECT root, MIN(filename) FROM files WHERE partialhash IS NULL AND size > ? '
+                         'GROUP BY key, algorithm ORDER BY root, 2', (min_size,))
+        return [(self._directories[root], filename) for root, filename in self._db.fetchall()]
+
+    def update_partial_hash(self, directory, filename):
+        root = self._directories.index(directory)
+        try:
+            partialhash = directory.update_partial_hash(filename)
+        except OSError:
+            self.remove_file(directory, filename)
+            return None
+        self._db.execute('UPDATE files SET partialhash = ? WHERE key = '
+                         '(SELECT key FROM files WHERE root = ? AND filename = ?) AND algorithm = ?',
+                         (partialhash, root, filename, directory.get_option_hash_algorithm()))
+        self._conn.commit()
+        return partialhash
+
+    def hash_for_update(self):
+        # Files with unique size in its directory are not hashed by update, neither files with unique partial
+        # hash between files of same size (files without partial hash are small, compared by size)
+        for directory, filename in self.partial_hash_for_update():
+            self.update_partial_hash(directory, filename)
+        self._db.execute('SELECT root, MIN(filename) FROM files WHERE hash IS NULL AND EXISTS '
+                         '(SELECT 1 FROM files AS other WHERE other.size = files.size AND other.key != files.key '
+                         'AND other.algorithm = files.algorithm AND (other.partialhash IS NULL OR '
+                         'files.partialhash IS NULL OR other.partialhash = files.partialhash)) '
+                         'GROUP BY key, algorithm ORDER BY root, 2')
+        for root, filename in self._db.fetchall():
+            yield self._directories[root], filename
+        for directory in self._directories:
+            directory.save_database()
+
+    def update_hash(self, directory, filename):
+        root = self._directories.index(directory)
+        try:
+            result = hash_file(os.path.join(str(directory), filename), directory.get_option_hash_algorithm())
+        except OSError:
+            self.remove_file(directory, filename)
+            return None
+        self._db.execute('SELECT root, filename FROM files WHERE key = '
+                         '(SELECT key FROM files WHERE root = ? AND filename = ?) AND algorithm = ?',
+                         (root, filename, directory.get_option_hash_algorithm()))
+        for link_root, link in self._db.fetchall():
+            self._directories[link_root].update_hash(link, result)
+            self._db.execute('UPDATE files SET hash = ? WHERE root = ? AND filename = ?',
+                             (result[2], link_root, link))
+        self._conn.commit()
+        return result[2]
+
+    def get_duplicated(self, order='size', reverse=False, limit=-1, offset=0):
+        if order not in ('size', 'wasted'):
+            raise ValueError('invalid order %s' % order)
+        cursor = self._conn.cursor()
+        # Hashs of different algorithms are never the same file
+        cursor.execute("SELECT files.algorithm || ':' || files.hash, files.size, files.root, files.filename, "
+                       'files.dev, files.inode FROM files '
+                       'JOIN (SELECT algorithm, hash, MAX(size) AS size, '
+                       '(COUNT(DISTINCT key) - 1) * MAX(size) AS wasted FROM files WHERE hash IS NOT NULL '
+                       'GROUP BY algorithm, hash HAVING COUNT(DISTINCT key) > 1 '
+                       'ORDER BY %(order)s %(direction)s, algorithm, hash LIMIT ? OFFSET ?) AS duplicated '
+                       'ON files.algorithm = duplicated.algorithm AND files.hash = duplicated.hash '
+                       'ORDER BY duplicated.%(order)s %(direction)s, files.algorithm, files.hash, '
+                       'files.root, files.filename' % {
+                           'order': order,
+                           'direction': 'DESC' if reverse else 'ASC',
+                       }, (limit, offset))
+        return group_duplicated((hashfile, size, os.path.join(str(self._directories[root]), filename), dev, inode)
+                                for hashfile, size, root, filename, dev, inode in cursor)
 
 
 # Create user directory if not exists
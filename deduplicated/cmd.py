@@ -8,9 +8,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import atexit
+import os
 import sys
+import threading
 
-from . import __version__, Directory, directory_delete, directory_list, str_size
+from . import (__version__, BLOCK_FILE_MIN, Directory, directory_all, directory_delete, directory_list, file_size,
+               find_files, GlobalIndex, HASH_ALGORITHMS, is_catalog, list_probe_files, migrate_catalog,
+               SIMILAR_THRESHOLD, str_size, str_time)
+from .metrics import Metrics, Progress
+from .scheduler import parse_size, Scheduler
+from .watch import watch
 
 
 # Argument parser
@@ -19,6 +27,29 @@ parser = argparse.ArgumentParser(prog='deduplicated')
 subparsers = parser.add_subparsers(dest='action')
 
 parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
+parser.add_argument('-q', '--quiet', action='store_true',
+                    help='show a progress bar instead of each file')
+parser.add_argument('--metrics', metavar='FILE',
+                    help='write timings of each phase in file, - for standard output')
+parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                    help='JSON lines or Prometheus textfile (default %(default)s)')
+parser.add_argument('--profile', metavar='DIRECTORY',
+                    help='write cProfile stats of each phase in directory')
+
+# Timings of phases, configured by main
+metrics = Metrics()
+# Lines and reports of directories updated at once are not mixed
+output_lock = threading.Lock()
+
+
+def add_scheduler_arguments(parser):
+    parser.add_argument('--directory-jobs', type=int, default=1,
+                        help='number of directories updated at once, least recently updated first')
+    parser.add_argument('--device-jobs', type=int, default=1,
+                        help='number of directories of same device updated at once')
+    parser.add_argument('--bandwidth', type=parse_size,
+                        help='bytes hashed by second of each device, as 50M')
+
 
 # list command
 parser_list = subparsers.add_parser('list',
@@ -27,21 +58,59 @@ parser_list = subparsers.add_parser('list',
 # update command
 parser_update = subparsers.add_parser('update',
                                       help='update directories informations')
+parser_update.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of directories listed and files hashed in parallel')
+parser_update.add_argument('--processes', action='store_true',
+                           help='hash with processes instead of threads')
+parser_update.add_argument('--hash', choices=sorted(HASH_ALGORITHMS),
+                           help='hash algorithm, changing it hash all files again')
+add_scheduler_arguments(parser_update)
 parser_update.add_argument('directory', nargs='*',
                            help='list of directories, if not present use all')
 
 # duplicated command
 parser_duplicated = subparsers.add_parser('duplicated',
                                           help='list duplicated files in directories')
+parser_duplicated.add_argument('--global', action='store_true', dest='global_index',
+                               help='list duplicated files between directories')
+parser_duplicated.add_argument('--order', choices=['size', 'wasted'], default='size',
+                               help='sort by file size or by space wasted by copies')
+parser_duplicated.add_argument('--reverse', action='store_true',
+                               help='sort in descending order')
+parser_duplicated.add_argument('--limit', type=int, default=-1,
+                               help='maximum number of hashs listed')
+parser_duplicated.add_argument('--offset', type=int, default=0,
+                               help='number of hashs skipped')
 parser_duplicated.add_argument('directory', nargs='*',
                                help='list of directories, if not present use all')
 
 # check command
 parser_check = subparsers.add_parser('check',
                                      help='update and duplicated directories')
+parser_check.add_argument('-j', '--jobs', type=int, default=1,
+                          help='number of directories listed and files hashed in parallel')
+parser_check.add_argument('--processes', action='store_true',
+                          help='hash with processes instead of threads')
+parser_check.add_argument('--hash', choices=sorted(HASH_ALGORITHMS),
+                          help='hash algorithm, changing it hash all files again')
+add_scheduler_arguments(parser_check)
 parser_check.add_argument('directory', nargs='*',
                           help='list of directories, if not present use all')
 
+# watch command
+parser_watch = subparsers.add_parser('watch',
+                                     help='keep directories updated while files change')
+parser_watch.add_argument('-j', '--jobs', type=int, default=1,
+                          help='number of directories listed and files hashed in parallel')
+parser_watch.add_argument('--processes', action='store_true',
+                          help='hash with processes instead of threads')
+parser_watch.add_argument('--interval', type=int, default=600,
+                          help='seconds between updates when polling')
+parser_watch.add_argument('--poll', action='store_true',
+                          help='update all directory each interval instead of use inotify')
+parser_watch.add_argument('directory', nargs='*',
+                          help='list of directories, if not present use all')
+
 # delete command
 parser_delete = subparsers.add_parser('delete',
                                       help='delete directory information')
@@ -51,19 +120,61 @@ parser_delete.add_argument('directory', nargs='+',
 # indir command
 parser_indir = subparsers.add_parser('indir',
                                      help='check file exists in directories')
+parser_indir.add_argument('--missing', action='store_true',
+                          help='list files not found instead of found')
 parser_indir.add_argument('file',
-                          help='file for check')
+                          help='file, or directory with files, for check')
 parser_indir.add_argument('directory', nargs='*',
                           help='list of directories, if not present use all')
 
 # delindir command
 parser_delindir = subparsers.add_parser('delindir',
                                         help='delete duplicated files in directory')
+parser_delindir.add_argument('--no-verify', action='store_false', dest='verify',
+                             help='delete without compare content of files')
 parser_delindir.add_argument('directory', nargs=1,
                              help='directory information')
 parser_delindir.add_argument('delindir',
                              help='subdirectory for delete')
 
+# verify command
+parser_verify = subparsers.add_parser('verify',
+                                      help='compare content of duplicated files')
+parser_verify.add_argument('directory', nargs='*',
+                           help='list of directories, if not present use all')
+
+# similar command
+parser_similar = subparsers.add_parser('similar',
+                                       help='list files with similar content in directories')
+parser_similar.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of files read in parallel')
+parser_similar.add_argument('--processes', action='store_true',
+                            help='read with processes instead of threads')
+parser_similar.add_argument('--threshold', type=float, default=SIMILAR_THRESHOLD,
+                            help='minimum similarity of files, from 0 to 1 (default %(default)s)')
+parser_similar.add_argument('directory', nargs='*',
+                            help='list of directories, if not present use all')
+
+# blocks command
+parser_blocks = subparsers.add_parser('blocks',
+                                      help='report space reclaimable by dedup of blocks in directories')
+parser_blocks.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of files read in parallel')
+parser_blocks.add_argument('--processes', action='store_true',
+                           help='read with processes instead of threads')
+parser_blocks.add_argument('--depth', type=int, default=1,
+                           help='depth of subtrees in report (default %(default)s)')
+parser_blocks.add_argument('--limit', type=int, default=20,
+                           help='number of pairs of files in report (default %(default)s)')
+parser_blocks.add_argument('--min-size', type=parse_size, default=BLOCK_FILE_MIN,
+                           help='files smaller are not chunked, as 64M (default 1M)')
+parser_blocks.add_argument('directory', nargs='*',
+                           help='list of directories, if not present use all')
+
+# catalog command
+parser_catalog = subparsers.add_parser('catalog',
+                                       help='move information of directories to a single catalog database')
+
 # optimize command
 parser_optimize = subparsers.add_parser('optimize',
                                         help='optimize cache database')
@@ -73,6 +184,28 @@ parser_optimize.add_argument('directory', nargs='*',
 
 # Utils
 
+def print_line(line):
+    with output_lock:
+        print(line)
+
+
+def print_file(line):
+    # Quiet mode shows the progress bar instead
+    if metrics.progress is None:
+        print_line(line)
+
+
+def str_progress(phase):
+    seconds = phase.get_seconds()
+    line = '%s (%s): %d files, %s' % (phase.name, phase.directory, phase.files, str_size(phase.bytes))
+    if seconds:
+        line += ', %s/s' % str_size(phase.bytes / seconds)
+    if phase.run is not None and phase.run['bytes_total']:
+        filled = 20 * phase.run['bytes_done'] // phase.run['bytes_total']
+        line = '[%-20s] %s%s' % ('#' * filled, line, str_run(phase.run))
+    return line
+
+
 def print_directories(directories):
     rows = [(str(directory),
              str(directory.get_lastupdate() or '-') + ('i' if not directory.is_completed() else ''),
@@ -92,22 +225,90 @@ def print_directories(directories):
                                              sizes[3], row[3], sizes[4], row[4]))
 
 
-def print_update_tree(directory):
-    print('==> Update tree (%s): ' % directory, end='')
-    print('+%d  ~%d  -%d' % directory.update_tree())
+def set_hash_algorithm(directory, algorithm):
+    if algorithm and algorithm != directory.get_option_hash_algorithm():
+        print_line('==> Hash algorithm (%s): %s' % (directory, algorithm))
+        directory.set_option_hash_algorithm(algorithm)
+        directory.save_meta()
 
 
-def print_update_hash(directory):
-    for filename in directory.hash_for_update():
-        print('Updating %s' % filename)
-        directory.update_hash(filename)
+def print_update_tree(directory, jobs=1):
+    with metrics.phase('scan', directory) as phase:
+        result = directory.update_tree(jobs)
+        phase.files, phase.bytes = directory.listed
+    print_line('==> Update tree (%s): +%d  ~%d  -%d' % ((directory,) + result))
+
+
+def str_run(run):
+    if run is None or not run['files_total']:
+        return ''
+    return '  [%d/%d, %d%%, ETA %s]' % (
+        run['files_done'],
+        run['files_total'],
+        100 * run['bytes_done'] // (run['bytes_total'] or 1),
+        str_time(run['eta']) if run['eta'] is not None else '-',
+    )
 
 
-def print_duplicated(directory):
+def hash_files(directory, jobs=1, processes=False):
+    if jobs > 1:
+        for filename in directory.update_hash_parallel(jobs, processes):
+            yield filename
+        return
+    for filename in directory.hash_for_update():
+        directory.update_hash(filename)
+        yield filename
+
+
+def print_update_hash(directory, jobs=1, processes=False, stop=None, absolute=False):
+    # Absolute filenames tell the directory of each file when directories are updated at once
+    with metrics.phase('hash', directory) as phase:
+        for filename in hash_files(directory, jobs, processes):
+            run = directory.get_run()
+            abs_filename = os.path.join(str(directory), filename)
+            phase.progress(filename, file_size(abs_filename), directory.queue_depth, run)
+            print_file('Updating %s%s' % (abs_filename if absolute else filename, str_run(run)))
+            if stop is not None and stop.is_set():
+                # Closed update keeps hashed files, resumed by next update
+                break
+
+
+def schedule_update(args, check=False):
+    # Profiles are of one phase at a time
+    directory_jobs = 1 if args.profile else args.directory_jobs
+    scheduler = Scheduler(args.directory, directory_jobs, args.device_jobs, args.bandwidth)
+    absolute = directory_jobs > 1 and len(args.directory) > 1
+
+    def update(directory):
+        set_hash_algorithm(directory, args.hash)
+        print_update_tree(directory, args.jobs)
+        print_update_hash(directory, args.jobs, args.processes, scheduler.stopped, absolute)
+        if check and not scheduler.stopped.is_set():
+            with output_lock:
+                print_duplicated(directory)
+
+    for dirname, error in scheduler.run(update):
+        print('==> Error (%s): %s' % (dirname, error), file=sys.stderr)
+    return not scheduler.errors
+
+
+def print_watch_update(directory, dirnames, jobs=1, processes=False):
+    with metrics.phase('scan', directory) as phase:
+        insert, update, delete = directory.update_tree(jobs, dirnames)
+        phase.files, phase.bytes = directory.listed
+    if insert or update or delete:
+        print('==> Update tree (%s): +%d  ~%d  -%d' % (directory, insert, update, delete))
+    print_update_hash(directory, jobs, processes)
+    sys.stdout.flush()
+
+
+def print_duplicated(directory, order='size', reverse=False, limit=-1, offset=0):
     print('==> Duplicated (%s):' % directory)
-    for hashfile, size, files in directory.get_duplicated():
-        print('%s [%s]' % (str_size(size), hashfile))
-        print('    %s' % '\n    '.join(files))
+    with metrics.phase('report', directory, progress=False) as phase:
+        for hashfile, size, files in directory.get_duplicated(order, reverse, limit, offset):
+            print('%s [%s]' % (str_size(size), hashfile))
+            print('    %s' % '\n    '.join(' = '.join(links) for links in files))
+            phase.progress(hashfile, size * len(files))
     print('%d hashs (%d files) %s' % (
         directory.get_duplicated_hash(),
         directory.get_duplicated_files(),
@@ -115,40 +316,126 @@ def print_duplicated(directory):
     ))
 
 
+def print_global_duplicated(index, order='size', reverse=False, limit=-1, offset=0):
+    with metrics.phase('hash') as phase:
+        for directory, filename in index.hash_for_update():
+            abs_filename = os.path.join(str(directory), filename)
+            print_file('Updating %s' % abs_filename)
+            index.update_hash(directory, filename)
+            phase.progress(abs_filename, file_size(abs_filename))
+
+    print('==> Duplicated (%s):' % ', '.join(str(directory) for directory in index.get_directories()))
+    d_hash = 0
+    d_files = 0
+    d_size = 0
+    with metrics.phase('report', progress=False) as phase:
+        for hashfile, size, files in index.get_duplicated(order, reverse, limit, offset):
+            print('%s [%s]' % (str_size(size), hashfile))
+            print('    %s' % '\n    '.join(' = '.join(links) for links in files))
+            d_hash += 1
+            d_files += sum(len(links) for links in files)
+            d_size += (len(files) - 1) * size
+            phase.progress(hashfile, size * len(files))
+    print('%d hashs (%d files) %s' % (d_hash, d_files, str_size(d_size)))
+
+
+def print_verify(directory):
+    print('==> Verify (%s):' % directory)
+    v_hash = 0
+    v_different = 0
+    with metrics.phase('verify', directory, progress=False) as phase:
+        for hashfile, size, groups in directory.verify_duplicated():
+            v_hash += 1
+            phase.progress(hashfile, size * sum(len(group) for group in groups))
+            if len(groups) == 1:
+                continue
+            v_different += 1
+            print('%s [%s] different content:' % (str_size(size), hashfile))
+            lines = ['\n    '.join(' = '.join(links) for links in group) for group in groups]
+            print('    %s' % '\n    ---\n    '.join(lines))
+    print('%d hashs verified, %d with different content (hashed again by next update)' % (v_hash, v_different))
+
+
+def print_similar(directory, threshold=SIMILAR_THRESHOLD, jobs=1, processes=False):
+    with metrics.phase('fingerprint', directory) as phase:
+        for filename in directory.update_fingerprint_parallel(jobs, processes):
+            phase.progress(filename, file_size(os.path.join(str(directory), filename)), directory.queue_depth)
+            print_file('Fingerprint %s' % filename)
+    print('==> Similar (%s):' % directory)
+    with metrics.phase('report', directory, progress=False) as phase:
+        groups = directory.get_similar(threshold)
+        phase.files = sum(len(group) for group in groups)
+    for group in groups:
+        print('%s in %d files' % (str_size(sum(size for _, size, _, _ in group)), len(group)))
+        for links, size, _, value in group:
+            print('    %3d%%  %10s  %s' % (100 * value, str_size(size), ' = '.join(links)))
+    print('%d groups' % len(groups))
+
+
+def print_blocks(directory, depth=1, limit=20, jobs=1, processes=False, min_size=BLOCK_FILE_MIN):
+    with metrics.phase('chunk', directory) as phase:
+        for filename in directory.update_blocks_parallel(jobs, processes, min_size):
+            phase.progress(filename, file_size(os.path.join(str(directory), filename)), directory.queue_depth)
+            print_file('Chunking %s' % filename)
+    print('==> Blocks (%s):' % directory)
+    with metrics.phase('report', directory, progress=False) as phase:
+        report = directory.get_blocks_report(depth, limit, min_size)
+        phase.files, phase.bytes = report['files'], report['bytes']
+    print('%d files (%s) in %d blocks' % (report['files'], str_size(report['bytes']), report['chunks']))
+    print('Reclaimable: %s by blocks, %s by whole files' % (str_size(report['reclaimable']),
+                                                            str_size(directory.get_duplicated_size())))
+    if report['pairs']:
+        print('Pairs of files:')
+        for filename, owner, size in report['pairs']:
+            print('    %10s  %s' % (str_size(size), filename if filename == owner else '%s <= %s' % (filename, owner)))
+    if report['subtrees']:
+        print('Subtrees:')
+        for dirname, size in report['subtrees']:
+            print('    %10s  %s' % (str_size(size), dirname))
+
+
 def print_optimize(directory, sizes):
     print('%9s - %s (%s > %s)' % (str_size(sizes[2]), directory, str_size(sizes[0]), str_size(sizes[1])))
 
 
 def main():
     args = parser.parse_args()
+    metrics.output = args.metrics
+    metrics.output_format = args.metrics_format
+    metrics.profile_dir = args.profile
+    if args.quiet:
+        metrics.progress = Progress(str_progress)
+    atexit.register(metrics.close)
 
     if 'directory' in args and not args.directory:
         args.directory = directory_list()
 
     if args.action == 'list':
-        directories = [Directory(dirname, checkvalid=False) for dirname in directory_list()]
-        print_directories(directories)
+        print_directories(directory_all())
         sys.exit(0)
 
     if args.action == 'update':
-        for dirname in args.directory:
-            directory = Directory(dirname)
-            print_update_tree(directory)
-            print_update_hash(directory)
-        sys.exit(0)
+        sys.exit(0 if schedule_update(args) else 1)
 
     if args.action == 'duplicated':
+        if args.global_index:
+            print_global_duplicated(GlobalIndex(args.directory), args.order, args.reverse, args.limit, args.offset)
+            sys.exit(0)
         for dirname in args.directory:
             directory = Directory(dirname)
-            print_duplicated(directory)
+            print_duplicated(directory, args.order, args.reverse, args.limit, args.offset)
         sys.exit(0)
 
     if args.action == 'check':
-        for dirname in args.directory:
-            directory = Directory(dirname)
-            print_update_tree(directory)
-            print_update_hash(directory)
-            print_duplicated(directory)
+        sys.exit(0 if schedule_update(args, check=True) else 1)
+
+    if args.action == 'watch':
+        directories = [Directory(dirname) for dirname in args.directory]
+        try:
+            for directory, dirnames in watch(directories, args.interval, poll=args.poll):
+                print_watch_update(directory, dirnames, args.jobs, args.processes)
+        except KeyboardInterrupt:
+            pass
         sys.exit(0)
 
     if args.action == 'delete':
@@ -159,13 +446,20 @@ def main():
 
     if args.action == 'indir':
         has = False
-        for dirname in args.directory:
-            directory = Directory(dirname)
-            files = directory.is_file_in(args.file)
+        batch = os.path.isdir(args.file)
+        directories = [Directory(dirname) for dirname in args.directory]
+        for probe, files in find_files(list_probe_files(args.file), directories):
             if files:
                 has = True
-                for filename in files:
-                    print(filename)
+            if args.missing:
+                if not files:
+                    print(probe)
+            elif files and batch:
+                print(probe)
+                print('    %s' % '\n    '.join(files))
+            elif files:
+                print('\n'.join(files))
+            sys.stdout.flush()
         if has:
             sys.exit(0)
         else:
@@ -176,13 +470,43 @@ def main():
         if not delindir.endswith('/'):
             delindir += '/'
         directory = Directory(args.directory[0])
-        directory.delete_duplicated_indir(delindir)
+        deleted, kept = directory.delete_duplicated_indir(delindir, args.verify)
+        for filename in deleted:
+            print('Deleted %s' % filename)
+        for filename in kept:
+            print('Kept %s (no other file with same content)' % filename)
+        sys.exit(0)
+
+    if args.action == 'verify':
+        for dirname in args.directory:
+            directory = Directory(dirname)
+            print_verify(directory)
+        sys.exit(0)
+
+    if args.action == 'similar':
+        for dirname in args.directory:
+            directory = Directory(dirname)
+            print_similar(directory, args.threshold, args.jobs, args.processes)
+        sys.exit(0)
+
+    if args.action == 'blocks':
+        for dirname in args.directory:
+            directory = Directory(dirname)
+            print_blocks(directory, args.depth, args.limit, args.jobs, args.processes, args.min_size)
+        sys.exit(0)
+
+    if args.action == 'catalog':
+        if is_catalog():
+            print('==> Catalog already exists, moving remaining directories')
+        for dirname in migrate_catalog():
+            print('Moved %s' % dirname)
         sys.exit(0)
 
     if args.action == 'optimize':
         for dirname in args.directory:
             directory = Directory(dirname)
-            sizes = directory.optimize_database()
+            with metrics.phase('optimize', directory):
+                sizes = directory.optimize_database()
             if not sizes[2]:
                 continue
             print_optimize(directory, sizes)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+
+# Global Vars
+
+# Time in SQLite of each thread, by all its connections, as directories may be updated at once
+SQLITE = threading.local()
+# Seconds between redraws of progress bar
+PROGRESS_INTERVAL = 0.5
+
+PROMETHEUS_PREFIX = 'deduplicated_phase_'
+PROMETHEUS_METRICS = OrderedDict([
+    ('seconds', 'Seconds of phase'),
+    ('files', 'Files processed by phase'),
+    ('bytes', 'Bytes processed by phase'),
+    ('files_per_second', 'Files processed by second'),
+    ('bytes_per_second', 'Bytes processed by second'),
+    ('sqlite_seconds', 'Seconds in SQLite queries and commits'),
+    ('sqlite_queries', 'SQLite queries and commits'),
+    ('queue_depth_max', 'Maximum of files sent to workers and not written to database'),
+])
+
+
+# SQLite
+
+def sqlite_counters():
+    if not hasattr(SQLITE, 'counters'):
+        SQLITE.counters = {'seconds': 0.0, 'queries': 0}
+    return SQLITE.counters
+
+
+class TimedRows(object):
+    # Rows given to executemany, time generating them is not SQLite time
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        try:
+            return next(self._rows)
+        finally:
+            self.seconds += time.time() - start
+
+    next = __next__
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        start = time.time()
+        try:
+            return super(TimedCursor, self).execute(*args)
+        finally:
+            sqlite_counters()['seconds'] += time.time() - start
+            sqlite_counters()['queries'] += 1
+
+    def executemany(self, sql, rows):
+        rows = TimedRows(rows)
+        start = time.time()
+        try:
+            return super(TimedCursor, self).executemany(sql, rows)
+        finally:
+            sqlite_counters()['seconds'] += time.time() - start - rows.seconds
+            sqlite_counters()['queries'] += 1
+
+    def fetchone(self):
+        start = time.time()
+        try:
+            return super(TimedCursor, self).fetchone()
+        finally:
+            sqlite_counters()['seconds'] += time.time() - start
+
+    def fetchall(self):
+        start = time.time()
+        try:
+            return super(TimedCursor, self).fetchall()
+        finally:
+            sqlite_counters()['seconds'] += time.time() - start
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super(TimedConnection, self).cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def commit(self):
+        start = time.time()
+        try:
+            return super(TimedConnection, self).commit()
+        finally:
+            sqlite_counters()['seconds'] += time.time() - start
+            sqlite_counters()['queries'] += 1
+
+
+def connect(filename):
+    return sqlite3.connect(filename, factory=TimedConnection)
+
+
+# Utils
+
+def prometheus_escape(value):
+    return re.sub(r'(["\\])', r'\\\1', value).replace('\n', '\\n')
+
+
+# Progress
+
+class Progress(object):
+    """Single line progress of a phase in a terminal, redrawn at most each interval seconds."""
+
+    def __init__(self, format_line, stream=None, interval=PROGRESS_INTERVAL):
+        self._format_line = format_line
+        self._stream = stream or sys.stderr
+        self._interval = interval
+        self._last = 0
+        self._width = 0
+        # Directories updated at once share the line, it shows the last updated phase
+        self._lock = threading.Lock()
+
+    def update(self, phase, force=False):
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last < self._interval:
+                return
+            self._last = now
+            line = self._format_line(phase)
+            self._stream.write('\r%-*s' % (self._width, line))
+            self._stream.flush()
+            self._width = len(line)
+
+    def clear(self):
+        with self._lock:
+            if self._width:
+                self._stream.write('\r%s\r' % (' ' * self._width))
+                self._stream.flush()
+            self._width = 0
+            self._last = 0
+
+
+# Metrics
+
+class Phase(object):
+    def __init__(self, name, directory, progress=None):
+        self.name = name
+        self.directory = directory
+        self.started = time.time()
+        self.finished = None
+        self.files = 0
+        self.bytes = 0
+        # Run of hash, with total of files and ETA
+        self.run = None
+        self.queue_depth_max = 0
+        self._sqlite = dict(sqlite_counters())
+        self.bar = progress
+
+    def get_seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def progress(self, filename=None, size=0, queue_depth=0, run=None):
+        self.files += 1
+        self.bytes += size
+        self.queue_depth_max = max(self.queue_depth_max, queue_depth)
+        if run is not None:
+            self.run = run
+        if self.bar is not None:
+            self.bar.update(self)
+
+    def finish(self):
+        self.finished = time.time()
+        seconds = self.get_seconds()
+        return OrderedDict([
+            ('phase', self.name),
+            ('directory', str(self.directory)),
+            ('started', self.started),
+            ('seconds', seconds),
+            ('files', self.files),
+            ('bytes', self.bytes),
+            ('files_per_second', self.files / seconds if seconds else 0),
+            ('bytes_per_second', self.bytes / seconds if seconds else 0),
+            ('sqlite_seconds', sqlite_counters()['seconds'] - self._sqlite['seconds']),
+            ('sqlite_queries', sqlite_counters()['queries'] - self._sqlite['queries']),
+            ('queue_depth_max', self.queue_depth_max),
+        ])
+
+
+class Metrics(object):
+    """Timings of phases of a command (scan, hash, report...), written as JSON lines or Prometheus textfile.
+
+    With profile_dir, each phase runs with cProfile and its stats are written
+    there (only the main thread is profiled, not the workers).
+    """
+
+    def __init__(self, output=None, output_format='json', profile_dir=None, progress=None):
+        self.output = output
+        self.output_format = output_format
+        self.profile_dir = profile_dir
+        self.progress = progress
+        self.records = []
+        # Phases of directories updated at once finish in their threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, directory='', progress=True):
+        # Phases printing its results do not show progress
+        phase = Phase(name, directory, self.progress if progress else None)
+        profile = None
+        if self.profile_dir:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield phase
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.dump_profile(profile, phase)
+            if phase.bar is not None:
+                phase.bar.clear()
+            self.add(phase.finish())
+
+    def dump_profile(self, profile, phase):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        # Phases are repeated by watch, started time in milliseconds keeps them apart
+        directory = re.sub(r'[^\w.-]+', '_', str(phase.directory)).strip('_')
+        filename = '%s-%s-%d.pstats' % (phase.name, directory, phase.started * 1000)
+        profile.dump_stats(os.path.join(self.profile_dir, filename))
+
+    def add(self, record):
+        with self._lock:
+            self._add(record)
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.output and self.output_format == 'json':
+            line = json.dumps(record) + '\n'
+            if self.output == '-':
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                with open(self.output, 'a') as fp:
+                    fp.write(line)
+        elif self.output and self.output != '-' and self.output_format == 'prometheus':
+            # Textfile is read whole by collector, always write it complete
+            self.write_prometheus()
+
+    def close(self):
+        if self.output == '-' and self.output_format == 'prometheus' and self.records:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        # Last record of each phase and directory
+        records = OrderedDict(((record['phase'], record['directory']), record) for record in self.records)
+        lines = []
+        for key, description in PROMETHEUS_METRICS.items():
+            lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, key, description))
+            lines.append('# TYPE %s%s gauge' % (PROMETHEUS_PREFIX, key))
+            for record in records.values():
+                lines.append('%s%s{phase="%s",directory="%s"} %r' % (PROMETHEUS_PREFIX, key,
+                                                                     prometheus_escape(record['phase']),
+                                                                     prometheus_escape(record['directory']),
+                                                                     float(record[key])))
+        text = '\n'.join(lines) + '\n'
+        if self.output == '-':
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+        tmpfilename = self.output + '.tmp'
+        with open(tmpfilename, 'w') as fp:
+            fp.write(text)
+        os.rename(tmpfilename, self.output)
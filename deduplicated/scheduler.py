@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from datetime import datetime
+import os
+import threading
+import time
+
+from . import Directory
+
+
+# Global Vars
+
+SCHEDULER_JOBS = 1
+SCHEDULER_DEVICE_JOBS = 1
+# Seconds of bandwidth that can be read at once after an idle period
+BANDWIDTH_BURST = 1
+# Seconds between checks of threads while waiting for directories
+JOIN_INTERVAL = 0.1
+
+SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+# Utils
+
+def parse_size(value):
+    # Size as 1024, 512K, 50M or 1G
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    size = float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit]
+    if size <= 0:
+        raise ValueError('size must be positive')
+    return int(size)
+
+
+def get_device(dirname):
+    try:
+        return os.stat(dirname).st_dev
+    except OSError:
+        return None
+
+
+def get_priority(dirname):
+    # Interrupted updates first, then never updated and least recently updated
+    try:
+        directory = Directory(dirname)
+    except IOError:
+        return (False, datetime.min)
+    return (directory.is_completed(), directory.get_lastupdate() or datetime.min)
+
+
+# Bandwidth
+
+class Bandwidth(object):
+    """Token bucket of bytes read by second, shared by threads reading from one device.
+
+    Reads larger than available wait, so the average rate stays at most rate.
+    """
+
+    def __init__(self, rate, burst=BANDWIDTH_BURST):
+        self.rate = rate
+        self.burst = rate * burst
+        self._available = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.time()
+            self._available = min(self.burst, self._available + (now - self._last) * self.rate)
+            self._last = now
+            # Debt of this read is waited here, next reads wait after it
+            self._available -= size
+            wait = -self._available / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Scheduler
+
+class Scheduler(object):
+    """Update of many directories at once, grouped by device (st_dev) of each directory.
+
+    At most jobs directories are updated at once, and at most device_jobs of
+    same device, so directories on different disks are read together without
+    seeking between directories of same disk. Bandwidth is the limit of bytes
+    hashed by second of each device.
+    """
+
+    def __init__(self, dirnames, jobs=SCHEDULER_JOBS, device_jobs=SCHEDULER_DEVICE_JOBS, bandwidth=None):
+        self.jobs = max(1, jobs)
+        self.device_jobs = max(1, device_jobs)
+        self.bandwidth = bandwidth
+        self.stopped = threading.Event()
+        self.errors = []
+        self._pending = [(dirname, get_device(dirname))
+                         for dirname in sorted(dirnames, key=get_priority)]
+        self._running = {}
+        self._bandwidths = {}
+        self._condition = threading.Condition()
+
+    def get_bandwidth(self, device):
+        if self.bandwidth is None:
+            return None
+        with self._condition:
+            if device not in self._bandwidths:
+                self._bandwidths[device] = Bandwidth(self.bandwidth)
+            return self._bandwidths[device]
+
+    def next_directory(self):
+        # First pending directory of a device with free job, None when stopped or all started
+        with self._condition:
+            while self._pending and not self.stopped.is_set():
+                for i, (dirname, device) in enumerate(self._pending):
+                    if self._running.get(device, 0) < self.device_jobs:
+                        del self._pending[i]
+                        self._running[device] = self._running.get(device, 0) + 1
+                        return dirname, device
+                self._condition.wait()
+            return None
+
+    def finish_directory(self, device):
+        with self._condition:
+            self._running[device] -= 1
+            self._condition.notify_all()
+
+    def stop(self):
+        # Running updates stop by checking stopped, pending directories are not started
+        with self._condition:
+            self.stopped.set()
+            self._condition.notify_all()
+
+    def worker(self, function):
+        while True:
+            item = self.next_directory()
+            if item is None:
+                return
+            dirname, device = item
+            try:
+                # Database connections are used only by the thread that opened them
+                directory = Directory(dirname)
+                directory.bandwidth = self.get_bandwidth(device)
+                function(directory)
+            except Exception as e:
+                self.errors.append((dirname, e))
+            finally:
+                self.finish_directory(device)
+
+    def run(self, function):
+        """Call function with Directory of each directory, in threads. Errors are kept in errors."""
+        threads = [threading.Thread(target=self.worker, args=(function,))
+                   for _ in range(min(self.jobs, len(self._pending)))]
+        for thread in threads:
+            thread.start()
+        try:
+            self.wait(threads)
+        except KeyboardInterrupt:
+            self.stop()
+            self.wait(threads)
+            raise
+        return self.errors
+
+    def wait(self, threads):
+        # Ctrl-C during join marks a running thread as stopped (before Python 3.13), so it is not waited at exit
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(JOIN_INTERVAL)
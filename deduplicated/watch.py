@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from . import compile_exclude, scan_directory
+
+
+# inotify, see inotify(7)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct(str('iIII'))
+
+
+if hasattr(os, 'fsencode'):
+    fsencode = os.fsencode
+    fsdecode = os.fsdecode
+else:
+    def fsencode(path):
+        return path.encode(sys.getfilesystemencoding()) if isinstance(path, unicode) else path  # noqa: F821
+
+    def fsdecode(path):
+        return path.decode(sys.getfilesystemencoding())
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+class Inotify(object):
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), '%s: %s' % (os.strerror(ctypes.get_errno()), path))
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self):
+        try:
+            data = os.read(self._fd, 2 ** 16)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+
+class DirectoryWatcher(object):
+    """Paths changed inside a directory, from inotify events of all its subdirectories."""
+
+    def __init__(self, directory, inotify):
+        self.directory = directory
+        self._inotify = inotify
+        self._is_excluded = compile_exclude(directory.exclude)
+        self._follow_link = directory.is_option_follow_link()
+        self._watches = {}
+        self.changed = set()
+        self.rescan = False
+        self.add_tree('')
+
+    def add_tree(self, dirname):
+        # Files created before the watch is added are found by the update of dirname
+        dirnames = [dirname]
+        while dirnames:
+            dirname = dirnames.pop()
+            try:
+                wd = self._inotify.add_watch(os.path.join(str(self.directory), dirname))
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            self._watches[wd] = dirname
+            for filename, is_dir, _ in scan_directory(os.path.join(str(self.directory), dirname), self._follow_link):
+                partial_filename = os.path.join(dirname, filename)
+                if is_dir and not self._is_excluded(partial_filename, filename):
+                    dirnames.append(partial_filename)
+
+    def remove_tree(self, dirname):
+        for wd, path in list(self._watches.items()):
+            if path == dirname or path.startswith(dirname + '/'):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+    def has_watch(self, wd):
+        return wd in self._watches
+
+    def handle(self, wd, mask, name):
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        dirname = self._watches.get(wd)
+        if dirname is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Handled by the event in parent directory
+            return
+        partial_filename = os.path.join(dirname, name)
+        if self._is_excluded(partial_filename, name):
+            return
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self.remove_tree(partial_filename)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(partial_filename)
+        self.changed.add(partial_filename)
+
+    def pop_changed(self):
+        # Paths inside other changed path are updated with it
+        changed = sorted(self.changed)
+        self.changed = set()
+        self.rescan = False
+        dirnames = []
+        for path in changed:
+            if not dirnames or not (path == dirnames[-1] or path.startswith(dirnames[-1] + '/')):
+                dirnames.append(path)
+        return dirnames
+
+
+def watch(directories, interval=60, delay=2, poll=False):
+    """Yield (directory, dirnames) to update, dirnames is None to update all directory.
+
+    All directories are updated when started. With inotify, changed paths are
+    yielded after delay seconds without new events, else all directories are
+    updated each interval seconds.
+    """
+    libc = None if poll else load_libc()
+    inotify = None
+    watchers = []
+    if libc is not None:
+        inotify = Inotify(libc)
+        try:
+            watchers = [DirectoryWatcher(directory, inotify) for directory in directories]
+        except OSError:
+            # Usually the limit of watches (fs.inotify.max_user_watches)
+            inotify.close()
+            inotify = None
+
+    try:
+        for directory in directories:
+            yield directory, None
+
+        if inotify is None:
+            while True:
+                time.sleep(interval)
+                for directory in directories:
+                    yield directory, None
+
+        last_event = None
+        while True:
+            timeout = None if last_event is None else max(0, last_event + delay - time.time())
+            readable, _, _ = select.select([inotify], [], [], timeout)
+            if readable:
+                for wd, mask, _, name in inotify.read():
+                    if mask & IN_Q_OVERFLOW:
+                        for watcher in watchers:
+                            watcher.rescan = True
+                        continue
+                    for watcher in watchers:
+                        if watcher.has_watch(wd):
+                            watcher.handle(wd, mask, name)
+                last_event = time.time()
+                continue
+
+            last_event = None
+            for watcher in watchers:
+                if watcher.rescan:
+                    watcher.pop_changed()
+                    yield watcher.directory, None
+                elif watcher.changed:
+                    yield watcher.directory, watcher.pop_changed()
+    finally:
+        if inotify is not None:
+            inotify.close()
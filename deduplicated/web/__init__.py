@@ -4,27 +4,123 @@
 # License: MIT (see LICENSE for details)
 #
 
-from flask import Flask, redirect, render_template, request
+import argparse
+import json
+import os
+
+from flask import abort, Flask, jsonify, redirect, render_template, request, Response
 import jinja2
 from tempfile import NamedTemporaryFile
 
-from .. import Directory, directory_by_hash, directory_delete, directory_list, str_size
+from .. import (compile_exclude, Directory, directory_all, directory_by_hash, directory_delete, directory_list,
+                file_size, get_global_filename, GlobalIndex, HASH_ALGORITHMS, SIMILAR_THRESHOLD, str_size, str_time)
+from .jobs import JobQueue
 
 
 # Init app
 
 jinja2.filters.FILTERS['str_size'] = str_size
+jinja2.filters.FILTERS['str_time'] = str_time
 
 app = Flask(__name__)
+app.config['JOBS'] = 1
+app.config['PROCESSES'] = False
+
+job_queue = JobQueue()
+
+# Hashs by page of duplicated files
+PAGE_SIZE = 100
+# Page of finished job by kind
+JOB_TEMPLATES = {
+    'update': 'dirupdate.html',
+    'optimize': 'optimize.html',
+    'option': 'option.html',
+    'indir': 'indir.html',
+    'delete': 'deletefile.html',
+    'similar': 'similar.html',
+}
+
+
+# Jobs, run in worker thread, Directory objects are created there for its own database connection
+
+def job_update(job, dirhash, jobs, processes):
+    directory = directory_by_hash(dirhash)
+    job.current = 'Listing files'
+    outtree = directory.update_tree(jobs)
+    outhash = []
+    for filename in directory.update_hash_parallel(jobs, processes):
+        job.progress(filename, file_size(os.path.join(str(directory), filename)))
+        job.eta = directory.get_run()['eta']
+        outhash.append(filename)
+    return {'outtree': outtree, 'outhash': outhash}
+
+
+def job_optimize(job, dirhash):
+    directory = directory_by_hash(dirhash)
+    job.current = directory.get_dbfilename()
+    return {'sizes': directory.optimize_database()}
+
+
+def job_option(job, dirhash, follow_link, hash_algorithm, exclude):
+    # Run as a job of the directory, so an update running with the old options does not save them back
+    directory = directory_by_hash(dirhash)
+    directory.set_option_follow_link(follow_link)
+    directory.set_option_hash_algorithm(hash_algorithm)
+    directory.save_meta()
+    directory.exclude = exclude
+    directory.save_exclude()
+    return {'follow_link': follow_link, 'hash_algorithm': hash_algorithm, 'exclude': exclude}
+
+
+def job_indir(job, dirhash, filename, name):
+    try:
+        directory = directory_by_hash(dirhash)
+        job.current = name
+        files = directory.is_file_in(filename)
+        job.progress(name, file_size(filename))
+    finally:
+        os.remove(filename)
+    return {'name': name, 'files': files}
+
+
+def job_delete(job, dirhash, filenames, verify):
+    directory = directory_by_hash(dirhash)
+    job.current = 'Verifying %d files' % len(filenames) if verify else 'Deleting %d files' % len(filenames)
+    deleted, kept = directory.delete_files(filenames, verify)
+    for filename in deleted:
+        job.progress(filename)
+    return {'deleted': deleted, 'kept': kept}
+
+
+def job_similar(job, dirhash, threshold, jobs, processes):
+    directory = directory_by_hash(dirhash)
+    for filename in directory.update_fingerprint_parallel(jobs, processes):
+        job.progress(filename, file_size(os.path.join(str(directory), filename)))
+    job.current = 'Comparing fingerprints'
+    return {'threshold': threshold, 'groups': directory.get_similar(threshold)}
+
+
+def job_global_update(job):
+    # Kept for pages of duplicated, read until next update
+    job.current = 'Reading caches'
+    index = GlobalIndex([d for d in directory_list() if os.path.isdir(d)], get_global_filename())
+    outhash = []
+    for directory, filename in index.hash_for_update():
+        abs_filename = os.path.join(str(directory), filename)
+        job.current = abs_filename
+        index.update_hash(directory, filename)
+        job.progress(abs_filename, file_size(abs_filename))
+        outhash.append(abs_filename)
+    return {'outhash': outhash}
 
 
 # Pages
 
 @app.route('/')
 def dirlist():
-    directories = [Directory(d, checkvalid=False) for d in directory_list()]
     return render_template('dirlist.html',
-                           directories=directories)
+                           directories=directory_all(),
+                           jobs=job_queue.list())
 
 
 @app.route('/dir/add', methods=['post'])
@@ -35,32 +131,118 @@ def diradd():
     return redirect('/')
 
 
+def global_args():
+    # Page of duplicated between directories, from the index of last global update
+    page = max(request.args.get('page', 1, type=int), 1)
+    if not os.path.exists(get_global_filename()):
+        return {'duplicated': None, 'page': page, 'pages': 1}
+    index = GlobalIndex(filename=get_global_filename())
+    return {
+        'duplicated': index.get_duplicated(reverse=True, limit=PAGE_SIZE, offset=(page - 1) * PAGE_SIZE),
+        'page': page,
+        'pages': max((index.count_duplicated() + PAGE_SIZE - 1) // PAGE_SIZE, 1),
+    }
+
+
+@app.route('/global')
+def globalinfo():
+    return render_template('global.html',
+                           outhash=None,
+                           **global_args())
+
+
+@app.route('/global/update')
+def globalupdate():
+    job = job_queue.submit('global', 'Update between directories', job_global_update, key='global')
+    return redirect('/job/%d' % job.id)
+
+
+def duplicated_args():
+    order = request.args.get('order', 'wasted')
+    if order not in ('size', 'wasted', 'path'):
+        abort(400)
+    return {
+        'order': order,
+        # Without arguments the biggest wasted space first, unchecked box is not sent
+        'reverse': request.args.get('reverse', '' if 'order' in request.args else '1') == '1',
+        'dirname': request.args.get('dirname', '').strip('/'),
+    }
+
+
 @app.route('/dir/<dirhash>')
 def dirinfo(dirhash):
+    directory = directory_by_hash(dirhash, checkvalid=False)
+    args = duplicated_args()
+    page = max(request.args.get('page', 1, type=int), 1)
+    count = directory.count_duplicated(args['dirname']) if args['dirname'] else directory.get_duplicated_hash()
     return render_template('dirinfo.html',
-                           directory=directory_by_hash(dirhash, checkvalid=False))
+                           directory=directory,
+                           hash_algorithms=sorted(HASH_ALGORITHMS),
+                           similar_threshold=SIMILAR_THRESHOLD,
+                           duplicated=directory.get_duplicated(limit=PAGE_SIZE, offset=(page - 1) * PAGE_SIZE, **args),
+                           args=args,
+                           page=page,
+                           pages=max((count + PAGE_SIZE - 1) // PAGE_SIZE, 1))
+
+
+@app.route('/dir/<dirhash>/duplicated.json')
+def dirduplicated(dirhash):
+    directory = directory_by_hash(dirhash, checkvalid=False)
+    duplicated = directory.get_duplicated(limit=request.args.get('limit', -1, type=int),
+                                          offset=request.args.get('offset', 0, type=int),
+                                          **duplicated_args())
+
+    # Groups are written while read from database
+    def generate():
+        yield '['
+        for i, (hashfile, size, files) in enumerate(duplicated):
+            yield (',\n' if i else '\n') + json.dumps({'hash': hashfile, 'size': size, 'files': files})
+        yield '\n]\n'
+
+    return Response(generate(), mimetype='application/json')
 
 
 @app.route('/dir/<dirhash>/option', methods=['post'])
 def diroption(dirhash):
     directory = directory_by_hash(dirhash)
-    directory.set_option_follow_link('followlink' in request.form)
-    directory.save_meta()
-    directory.exclude = request.form.get('exclude', '').splitlines()
-    directory.save_exclude()
-    return redirect('/dir/%s' % dirhash)
+    exclude = request.form.get('exclude', '').splitlines()
+    try:
+        compile_exclude(exclude)
+    except ValueError as e:
+        # Saved excludes are used by every update, a bad line is rejected before save
+        abort(400, str(e))
+    hash_algorithm = request.form.get('hashalgorithm', directory.get_option_hash_algorithm())
+    if hash_algorithm not in HASH_ALGORITHMS:
+        abort(400, 'hash algorithm %s is not available' % hash_algorithm)
+    job = job_queue.submit('option', 'Options of %s' % directory, job_option,
+                           dirhash, 'followlink' in request.form, hash_algorithm, exclude, key=dirhash, merge=False)
+    return redirect('/job/%d' % job.id)
 
 
 @app.route('/dir/<dirhash>/update')
 def dirupdate(dirhash):
     directory = directory_by_hash(dirhash)
-    outtree = directory.update_tree()
-    outhash = list(directory.hash_for_update())
-    [directory.update_hash(i) for i in outhash]
-    return render_template('dirupdate.html',
-                           directory=directory,
-                           outtree=outtree,
-                           outhash=outhash)
+    job = job_queue.submit('update', 'Update %s' % directory, job_update,
+                           dirhash, app.config['JOBS'], app.config['PROCESSES'], key=dirhash)
+    return redirect('/job/%d' % job.id)
+
+
+@app.route('/dir/<dirhash>/optimize')
+def diroptimize(dirhash):
+    directory = directory_by_hash(dirhash)
+    job = job_queue.submit('optimize', 'Optimize %s' % directory, job_optimize, dirhash, key=dirhash)
+    return redirect('/job/%d' % job.id)
+
+
+@app.route('/dir/<dirhash>/similar')
+def dirsimilar(dirhash):
+    directory = directory_by_hash(dirhash)
+    threshold = request.args.get('threshold', SIMILAR_THRESHOLD, type=float)
+    if not 0 < threshold <= 1:
+        abort(400)
+    job = job_queue.submit('similar', 'Similar files in %s' % directory, job_similar,
+                           dirhash, threshold, app.config['JOBS'], app.config['PROCESSES'], key=dirhash)
+    return redirect('/job/%d' % job.id)
 
 
 @app.route('/dir/<dirhash>/delete')
@@ -72,24 +254,58 @@ def dirdelete(dirhash):
 @app.route('/dir/<dirhash>/deletefile', methods=['post'])
 def dirdeletefile(dirhash):
     directory = directory_by_hash(dirhash)
-    for filename in request.form.getlist('file'):
-        directory.delete_file(filename)
-    return redirect('/dir/%s' % dirhash)
+    job = job_queue.submit('delete', 'Delete files in %s' % directory, job_delete,
+                           dirhash, request.form.getlist('file'), 'verify' in request.form, key=dirhash, merge=False)
+    return redirect('/job/%d' % job.id)
 
 
 @app.route('/dir/<dirhash>/indir', methods=['post'])
 def indir(dirhash):
     directory = directory_by_hash(dirhash)
-    with NamedTemporaryFile(prefix='deduplicated-') as tmpfile:
-        request.files.get('file').save(tmpfile.name)
-        files = directory.is_file_in(tmpfile.name)
-    return render_template('indir.html',
-                           directory=directory,
-                           name=request.files.get('file').filename,
-                           files=files)
+    # Removed by job
+    with NamedTemporaryFile(prefix='deduplicated-', delete=False) as tmpfile:
+        request.files.get('file').save(tmpfile)
+    name = request.files.get('file').filename
+    job = job_queue.submit('indir', 'Check "%s" in %s' % (name, directory), job_indir, dirhash, tmpfile.name, name)
+    return redirect('/job/%d' % job.id)
+
+
+@app.route('/job/<int:jobid>')
+def jobinfo(jobid):
+    job = job_queue.get(jobid) or abort(404)
+    if job.status != 'done':
+        return render_template('job.html',
+                               job=job)
+    if job.kind == 'global':
+        return render_template('global.html',
+                               job=job,
+                               **dict(job.result, **global_args()))
+    return render_template(JOB_TEMPLATES[job.kind],
+                           directory=directory_by_hash(job.args[0], checkvalid=False),
+                           job=job,
+                           **job.result)
+
+
+@app.route('/job/<int:jobid>/status')
+def jobstatus(jobid):
+    job = job_queue.get(jobid) or abort(404)
+    return jsonify(job.to_dict())
 
 
 # Run
 
+parser = argparse.ArgumentParser(prog='deduplicated-web')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of directories listed and files hashed in parallel')
+parser.add_argument('--processes', action='store_true',
+                    help='hash with processes instead of threads')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of background jobs run at same time')
+
+
 def main():
+    args = parser.parse_args()
+    app.config['JOBS'] = args.jobs
+    app.config['PROCESSES'] = args.processes
+    job_queue.workers = args.workers
     app.run(port=5050)
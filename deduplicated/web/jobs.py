@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict, deque
+from itertools import count
+import threading
+import time
+import traceback
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+# Global Vars
+
+JOBS_HISTORY = 50
+
+
+# Jobs
+
+class Job(object):
+    def __init__(self, jobid, kind, title, function, args, key=None):
+        self.id = jobid
+        self.kind = kind
+        self.title = title
+        self.key = key
+        self.status = 'waiting'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.files = 0
+        self.bytes = 0
+        self.current = None
+        self.eta = None
+        self.result = None
+        self.error = None
+        self._function = function
+        self.args = args
+
+    def progress(self, filename, size=0):
+        self.files += 1
+        self.bytes += size
+        self.current = filename
+
+    def is_finished(self):
+        return self.status in ('done', 'error')
+
+    def get_elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        elapsed = self.get_elapsed()
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'title': self.title,
+            'status': self.status,
+            'elapsed': elapsed,
+            'files': self.files,
+            'bytes': self.bytes,
+            'files_per_second': self.files / elapsed if elapsed else 0,
+            'bytes_per_second': self.bytes / elapsed if elapsed else 0,
+            'current': self.current,
+            'eta': self.eta,
+            'error': self.error,
+        }
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.result = self._function(self, *self.args)
+            self.status = 'done'
+        except Exception:
+            self.error = traceback.format_exc()
+            self.status = 'error'
+        self.finished = time.time()
+        self.current = None
+
+
+class JobQueue(object):
+    """Run jobs in worker threads, keeping the last finished jobs for report."""
+
+    def __init__(self, workers=1):
+        # Workers are started by first job, workers can be changed before it
+        self.workers = workers
+        self._started = False
+        self._queue = Queue()
+        self._jobs = OrderedDict()
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        # Jobs waiting by running key, the next job of a key is queued when the previous finishes
+        self._keys = {}
+
+    def _start(self):
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+        self._started = True
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.run()
+            if job.key is None:
+                continue
+            with self._lock:
+                waiting = self._keys[job.key]
+                if not waiting:
+                    del self._keys[job.key]
+                    continue
+                job = waiting.popleft()
+            self._queue.put(job)
+
+    def submit(self, kind, title, function, *args, **kwargs):
+        # Jobs with same key run one after other in submit order, a pending job of same kind, key and arguments
+        # is returned, unless merge is false (as jobs that must all run)
+        key = kwargs.get('key')
+        with self._lock:
+            if not self._started:
+                self._start()
+            if key is not None and kwargs.get('merge', True):
+                for job in self._jobs.values():
+                    if job.kind == kind and job.key == key and job.args == args and not job.is_finished():
+                        return job
+            job = Job(next(self._ids), kind, title, function, args, key)
+            self._jobs[job.id] = job
+            finished = [j.id for j in self._jobs.values() if j.is_finished()]
+            for jobid in finished[:max(0, len(finished) - JOBS_HISTORY)]:
+                del self._jobs[jobid]
+            # Workers only get jobs that can run now, a job of a running key waits without holding a worker
+            if key is not None:
+                if key in self._keys:
+                    self._keys[key].append(job)
+                    return job
+                self._keys[key] = deque()
+        self._queue.put(job)
+        return job
+
+    def get(self, jobid):
+        return self._jobs.get(jobid)
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
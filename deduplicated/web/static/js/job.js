@@ -0,0 +1,52 @@
+(function () {
+  'use strict';
+
+  var info = document.querySelector('.job[data-status]');
+  var units = ['B', 'KB', 'MB', 'GB', 'TB'];
+
+  function strSize(size) {
+    var unit = 0;
+    while (size >= 1024 && unit < units.length - 1) {
+      size /= 1024;
+      unit++;
+    }
+    return (unit ? size.toFixed(2) : size) + ' ' + units[unit];
+  }
+
+  function strTime(seconds) {
+    seconds = Math.floor(seconds);
+    var minutes = Math.floor(seconds / 60) % 60;
+    var secs = seconds % 60;
+    return Math.floor(seconds / 3600) + ':' + (minutes < 10 ? '0' : '') + minutes + ':' + (secs < 10 ? '0' : '') + secs;
+  }
+
+  function update() {
+    var request = new XMLHttpRequest();
+    request.open('GET', info.getAttribute('data-status'));
+    request.onload = function () {
+      var job = JSON.parse(request.responseText);
+      // Finished page show the result
+      if (job.status === 'done' || job.status === 'error') {
+        window.location.reload();
+        return;
+      }
+      Array.prototype.forEach.call(document.querySelectorAll('[data-field]'), function (field) {
+        var value = job[field.getAttribute('data-field')];
+        if (value === null) {
+          value = '-';
+        } else if (field.hasAttribute('data-time')) {
+          value = strTime(value);
+        } else if (field.hasAttribute('data-size')) {
+          value = strSize(Math.floor(value));
+        } else if (field.hasAttribute('data-rate')) {
+          value = value.toFixed(1);
+        }
+        field.textContent = value;
+      });
+      setTimeout(update, 1000);
+    };
+    request.send();
+  }
+
+  setTimeout(update, 1000);
+})();
@@ -11,8 +11,12 @@ setup(
     version=version,
     packages=find_packages(),
 
+    install_requires=[
+        'scandir; python_version < "3.5"',
+    ],
     extras_require={
         'web': ['Flask'],
+        'fast': ['xxhash', 'blake3'],
     },
 
     author='Eduardo Klosowski',
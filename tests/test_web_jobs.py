@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Eduardo Klosowski
+# License: MIT (see LICENSE for details)
+#
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import deduplicated
+from deduplicated.web.jobs import JobQueue
+
+try:
+    from deduplicated.web import app, job_queue
+except ImportError:
+    app = None
+
+
+def wait_jobs(jobs, timeout=10):
+    end = time.time() + timeout
+    while not all(job.is_finished() for job in jobs):
+        if time.time() > end:
+            raise AssertionError('jobs not finished')
+        time.sleep(0.01)
+
+
+def blocking_job(job, event):
+    event.wait()
+
+
+class JobQueueTest(unittest.TestCase):
+    def test_pending_job_of_other_kind_is_not_returned(self):
+        queue = JobQueue()
+        event = threading.Event()
+        update = queue.submit('update', 'Update', blocking_job, event, key='dir')
+        optimize = queue.submit('optimize', 'Optimize', lambda job: 'optimized', key='dir')
+        self.assertIsNot(update, optimize)
+        self.assertIs(queue.submit('update', 'Update', blocking_job, event, key='dir'), update)
+        event.set()
+        wait_jobs([update, optimize])
+        self.assertEqual(optimize.result, 'optimized')
+
+    def test_pending_job_with_other_arguments_is_not_returned(self):
+        queue = JobQueue()
+        event = threading.Event()
+        update = queue.submit('update', 'Update', blocking_job, event, key='dir')
+        similar = queue.submit('similar', 'Similar', lambda job, threshold: threshold, 0.5, key='dir')
+        self.assertIs(queue.submit('similar', 'Similar', lambda job, threshold: threshold, 0.5, key='dir'), similar)
+        other = queue.submit('similar', 'Similar', lambda job, threshold: threshold, 0.8, key='dir')
+        self.assertIsNot(other, similar)
+        event.set()
+        wait_jobs([update, similar, other])
+        self.assertEqual((similar.result, other.result), (0.5, 0.8))
+
+    def test_jobs_of_key_run_in_order(self):
+        queue = JobQueue(workers=3)
+        event = threading.Event()
+        started = []
+        update = queue.submit('update', 'Update', blocking_job, event, key='dir')
+        jobs = [queue.submit('delete', 'Delete', lambda job, name: started.append(name), name, key='dir', merge=False)
+                for name in 'abcde']
+        event.set()
+        wait_jobs([update] + jobs)
+        self.assertEqual(started, list('abcde'))
+
+    def test_waiting_job_does_not_hold_worker(self):
+        queue = JobQueue(workers=2)
+        event = threading.Event()
+        update = queue.submit('update', 'Update', blocking_job, event, key='dir')
+        optimize = queue.submit('optimize', 'Optimize', lambda job: 'optimized', key='dir')
+        other = queue.submit('update', 'Update', lambda job: 'updated', key='other')
+        wait_jobs([other])
+        self.assertEqual((update.status, optimize.status), ('running', 'waiting'))
+        event.set()
+        wait_jobs([update, optimize])
+
+    def test_deletes_are_not_merged(self):
+        queue = JobQueue()
+        event = threading.Event()
+        update = queue.submit('update', 'Update', blocking_job, event, key='dir')
+        deletes = [queue.submit('delete', 'Delete', lambda job, files: files, files, key='dir', merge=False)
+                   for files in (['a'], ['b'], ['a'])]
+        self.assertEqual(len(set(job.id for job in [update] + deletes)), 4)
+        # Run after the update of same key
+        self.assertTrue(all(job.status == 'waiting' for job in deletes))
+        event.set()
+        wait_jobs([update] + deletes)
+        self.assertEqual([job.result for job in deletes], [['a'], ['b'], ['a']])
+
+
+@unittest.skipIf(app is None, 'Flask not installed')
+class DeleteFileRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.addCleanup(shutil.rmtree, self.path)
+        self.orig_cache_dir = deduplicated.CACHE_DIR
+        deduplicated.CACHE_DIR = self.cache_dir
+        self.addCleanup(setattr, deduplicated, 'CACHE_DIR', self.orig_cache_dir)
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(self.path, name), 'w') as fp:
+                fp.write('same content')
+        directory = deduplicated.Directory(self.path)
+        directory.update_tree()
+        for filename in directory.hash_for_update():
+            directory.update_hash(filename)
+        self.dirhash = directory.get_hash()
+        self.client = app.test_client()
+
+    def delete(self, filename):
+        response = self.client.post('/dir/%s/deletefile' % self.dirhash, data={'file': filename, 'verify': '1'})
+        self.assertEqual(response.status_code, 302)
+        return job_queue.get(int(response.headers['Location'].rsplit('/', 1)[1]))
+
+    def test_delete_while_update_pending(self):
+        event = threading.Event()
+        update = job_queue.submit('update', 'Update', blocking_job, event, key=self.dirhash)
+        delete_a = self.delete('a')
+        delete_b = self.delete('b')
+        self.assertEqual(len(set(job.id for job in (update, delete_a, delete_b))), 3)
+        self.assertEqual((delete_a.kind, delete_b.kind), ('delete', 'delete'))
+        event.set()
+        wait_jobs([update, delete_a, delete_b])
+        self.assertEqual(delete_a.result, {'deleted': ['a'], 'kept': []})
+        self.assertEqual(delete_b.result, {'deleted': ['b'], 'kept': []})
+        self.assertEqual(os.listdir(self.path), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()